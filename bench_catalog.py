@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Benchmark del catálogo: memoria por archivo y latencia de sorteo.
+
+Compara la lista de dicts que devuelve Drive con MediaCatalog para carpetas
+sintéticas de distintos tamaños. Cada tamaño corre en un proceso aparte.
+Los sorteos reproducen los filtros del bot: límite de GIF normal, límite
+reducido (modo degradado) y solo imágenes estáticas (shedding).
+
+Uso:
+    python bench_catalog.py [--sizes 10000 100000 1000000] [--draws 20000]
+                            [--gif-ratio 0.3]
+"""
+
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from bench_common import emit_result, run_child_process
+
+MB = 1024 * 1024
+
+
+def drive_listing(count: int, gif_ratio: float) -> str:
+    """Listado como el JSON de files.list, para que las cadenas no salgan internadas."""
+    rng = random.Random(count)
+    files = []
+    for i in range(count):
+        gif = rng.random() < gif_ratio
+        size = int(rng.lognormvariate(15.5, 1.2)) if gif else rng.randint(50_000, 6 * MB)
+        files.append({
+            "id": "".join(rng.choices("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_", k=33)),
+            "name": f"luke_{i:07d}.{'gif' if gif else 'jpg'}",
+            "mimeType": "image/gif" if gif else "image/jpeg",
+            "size": str(size),
+            "md5Checksum": "%032x" % rng.getrandbits(128),
+            "imageMediaMetadata": {"width": rng.randint(300, 4000), "height": rng.randint(300, 4000)},
+        })
+    return json.dumps(files)
+
+
+def measure(build):
+    """(objeto, bytes asignados, segundos) al construir con `build`."""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    value = build()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, allocated, elapsed
+
+
+def parse_listing(raw: str):
+    """measure() de json.loads; el texto se libera al volver, antes de medir el catálogo."""
+    return measure(lambda: json.loads(raw))
+
+
+def per_draw_us(draw, draws: int) -> float:
+    started = time.perf_counter()
+    for _ in range(draws):
+        draw()
+    return (time.perf_counter() - started) / draws * 1e6
+
+
+def run_child(size: int, draws: int, gif_ratio: float) -> dict:
+    import lukeybot
+
+    files, list_bytes, list_seconds = parse_listing(drive_listing(size, gif_ratio))
+    catalog, catalog_bytes, catalog_seconds = measure(lambda: lukeybot.MediaCatalog(files))
+
+    gif_limit = lukeybot.MAX_GIF_SIZE_BYTES
+    degraded_limit = 8 * MB
+
+    def list_draw(limit):
+        # Lo que hacía el bot: random.choice y descartar GIFs fuera del límite
+        for _ in range(10):
+            f = random.choice(files)
+            if f["mimeType"] != "image/gif" or int(f["size"]) <= limit:
+                return f
+        return None
+
+    def list_static_draw():
+        # Shedding: se filtraba una lista nueva en cada comando
+        return random.choice([f for f in files if f["mimeType"] != "image/gif"])
+
+    list_draws = max(1, draws // 1000)  # filtrar la lista entera es lento: menos repeticiones
+    return {
+        "size": size,
+        "list_bytes": list_bytes / size,
+        "catalog_bytes": catalog_bytes / size,
+        "list_build_s": list_seconds,
+        "catalog_build_s": catalog_seconds,
+        "list_draw_us": per_draw_us(lambda: list_draw(gif_limit), draws),
+        "list_degraded_us": per_draw_us(lambda: list_draw(degraded_limit), draws),
+        "list_static_us": per_draw_us(list_static_draw, list_draws),
+        "catalog_draw_us": per_draw_us(lambda: catalog.draw(gif_limit), draws),
+        "catalog_degraded_us": per_draw_us(lambda: catalog.draw(degraded_limit), draws),
+        "catalog_static_us": per_draw_us(lambda: catalog.draw(0), draws),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--draws", type=int, default=20_000, help="sorteos por medición")
+    parser.add_argument("--gif-ratio", type=float, default=0.3, help="fracción de GIFs en la carpeta")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_child(args.sizes[0], args.draws, args.gif_ratio)
+        emit_result(result)
+        return
+
+    print(f"{args.draws} sorteos por medición, {args.gif_ratio:.0%} GIFs\n")
+    print(f"{'archivos':>9} {'estructura':>11} {'B/archivo':>10} {'construir s':>12} "
+          f"{'sorteo µs':>10} {'degradado µs':>13} {'estáticas µs':>13}")
+    for size in args.sizes:
+        r = run_child_process(__file__, ["--sizes", str(size), "--draws", str(args.draws),
+                                         "--gif-ratio", str(args.gif_ratio)])
+        print(f"{size:>9} {'dicts':>11} {r['list_bytes']:>10.0f} {r['list_build_s']:>12.2f} "
+              f"{r['list_draw_us']:>10.2f} {r['list_degraded_us']:>13.2f} {r['list_static_us']:>13.0f}")
+        print(f"{size:>9} {'catálogo':>11} {r['catalog_bytes']:>10.0f} {r['catalog_build_s']:>12.2f} "
+              f"{r['catalog_draw_us']:>10.2f} {r['catalog_degraded_us']:>13.2f} {r['catalog_static_us']:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
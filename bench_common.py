@@ -0,0 +1,33 @@
+"""Utilidades compartidas por los benchmarks (bench_memory.py, bench_catalog.py).
+
+Cada medición corre en un proceso hijo para que no se contaminen entre sí;
+el hijo imprime su resultado en una línea marcada porque el bot también
+registra en stdout.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+# lukeybot valida la configuración al importarse; para los benchmarks basta con valores de relleno
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+os.environ.setdefault("DRIVE_FOLDER_ID", "benchmark")
+os.environ.setdefault("GOOGLE_SERVICE_ACCOUNT_FILE", "service_account.json")
+os.environ.setdefault("AUTO_POST_SCHEDULES_FILE", "")
+os.environ.setdefault("LOG_FILE", "")
+
+RESULT_MARKER = "BENCH_RESULT "
+
+
+def emit_result(result: dict):
+    """Desde el proceso hijo: publica el resultado para run_child_process."""
+    print(RESULT_MARKER + json.dumps(result), flush=True)
+
+
+def run_child_process(script: str, args: list) -> dict:
+    """Ejecuta `script --child args...` y devuelve el resultado que publicó."""
+    cmd = [sys.executable, script, "--child", *args]
+    out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    line = next(l for l in out.splitlines() if l.startswith(RESULT_MARKER))
+    return json.loads(line[len(RESULT_MARKER):])
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Benchmark de memoria: RSS del bot frente a un número simulado de servidores.
+
+Compara la configuración por defecto con LOW_MEMORY_MODE alimentando el
+estado de discord.py con payloads GUILD_CREATE y MESSAGE_CREATE sintéticos,
+igual que haría el gateway. Cada medición corre en un proceso aparte.
+
+Sin el intent privilegiado de miembros el gateway solo envía el miembro del
+propio bot; --members-intent simula un despliegue que lo activa en la
+configuración por defecto, que es donde la caché de miembros pesa.
+
+Uso:
+    python bench_memory.py [--guilds 100 1000 5000] [--channels 20]
+                           [--members 100] [--messages 30] [--mode prefix]
+                           [--members-intent]
+"""
+
+import argparse
+import gc
+
+from bench_common import emit_result, run_child_process
+
+BOT_USER_ID = 1
+
+
+def rss_bytes() -> int:
+    """RSS actual del proceso (Linux); si no, el máximo que reporta getrusage."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def user_payload(user_id: int, name: str) -> dict:
+    return {"id": str(user_id), "username": name, "discriminator": "0", "avatar": None, "global_name": None}
+
+
+def member_payload(user_id: int, name: str) -> dict:
+    return {"user": user_payload(user_id, name), "roles": [], "joined_at": "2024-01-01T00:00:00+00:00",
+            "deaf": False, "mute": False, "flags": 0}
+
+
+def guild_payload(guild_id: int, channels: int, members: int) -> dict:
+    """GUILD_CREATE con el miembro del bot y `members` miembros más."""
+    base = guild_id * 100_000
+    return {
+        "id": str(guild_id),
+        "name": f"guild-{guild_id}",
+        "member_count": members,
+        "large": members > 250,
+        "features": [],
+        "emojis": [],
+        "stickers": [],
+        "roles": [{
+            "id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0,
+            "color": 0, "hoist": False, "managed": False, "mentionable": False, "flags": 0,
+        }],
+        "channels": [
+            {"id": str(base + c), "type": 0, "name": f"canal-{c}", "position": c,
+             "permission_overwrites": [], "guild_id": str(guild_id)}
+            for c in range(channels)
+        ],
+        "members": [member_payload(BOT_USER_ID, "lukeybot")]
+                   + [member_payload(base + 50_000 + m, f"user{m}") for m in range(members)],
+    }
+
+
+def message_payload(guild_id: int, channel_id: int, message_id: int) -> dict:
+    return {
+        "id": str(message_id),
+        "channel_id": str(channel_id),
+        "guild_id": str(guild_id),
+        "type": 0,
+        "content": "mensaje de prueba con algo de texto para ocupar memoria realista",
+        "author": {"id": str(message_id % 997 + 1), "username": "autor", "discriminator": "0",
+                   "avatar": None, "global_name": None},
+        "timestamp": "2024-01-01T00:00:00+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+    }
+
+
+def run_child(low_memory: bool, mode: str, guilds: int, channels: int, members: int, messages: int,
+              members_intent: bool) -> dict:
+    import discord
+    import lukeybot
+
+    before = rss_bytes()
+    options = lukeybot.build_gateway_options(low_memory, mode)
+    intents = options["intents"]
+    if members_intent and not low_memory:
+        intents.members = True
+    client = discord.Client(**options)
+    state = client._connection
+    # El miembro del propio bot siempre se cachea: hace falta que el estado sepa quién es
+    state.user = discord.ClientUser(state=state, data=user_payload(BOT_USER_ID, "lukeybot"))
+
+    message_id = 10**15
+    delivered = 0
+    for g in range(1, guilds + 1):
+        # Sin el intent de miembros el gateway solo envía el del bot
+        data = guild_payload(g, channels, members if intents.members else 0)
+        state._add_guild_from_data(data)
+        # Sin el intent de mensajes el gateway no envía MESSAGE_CREATE
+        if intents.guild_messages:
+            for c in range(channels):
+                for _ in range(messages // channels or 1):
+                    message_id += 1
+                    state.parse_message_create(message_payload(g, g * 100_000 + c, message_id))
+                    delivered += 1
+
+    gc.collect()
+    after = rss_bytes()
+    return {
+        "low_memory": low_memory,
+        "guilds": guilds,
+        "rss_mb": after / 1024 / 1024,
+        "delta_mb": (after - before) / 1024 / 1024,
+        "cached_messages": len(state._messages) if state._messages is not None else 0,
+        "delivered_messages": delivered,
+        "cached_members": sum(len(guild._members) for guild in state._guilds.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=30, help="mensajes recibidos por servidor")
+    parser.add_argument("--mode", choices=["prefix", "slash", "both"], default="prefix")
+    parser.add_argument("--members-intent", action="store_true",
+                        help="activar el intent de miembros en la configuración por defecto")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--low-memory", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_child(args.low_memory, args.mode, args.guilds[0], args.channels, args.members, args.messages,
+                           args.members_intent)
+        emit_result(result)
+        return
+
+    print(f"Modo de comandos: {args.mode}, {args.channels} canales y {args.members} miembros por servidor, "
+          f"{args.messages} mensajes por servidor, intent de miembros "
+          f"{'activado' if args.members_intent else 'desactivado'} por defecto\n")
+    print(f"{'servidores':>10} {'modo':>12} {'RSS MB':>9} {'Δ MB':>9} {'msgs caché':>11} {'miembros':>9}")
+    for guilds in args.guilds:
+        for low_memory in (False, True):
+            child_args = ["--guilds", str(guilds), "--channels", str(args.channels), "--members", str(args.members),
+                          "--messages", str(args.messages), "--mode", args.mode]
+            if args.members_intent:
+                child_args.append("--members-intent")
+            if low_memory:
+                child_args.append("--low-memory")
+            r = run_child_process(__file__, child_args)
+            label = "low-memory" if low_memory else "default"
+            print(f"{guilds:>10} {label:>12} {r['rss_mb']:>9.1f} {r['delta_mb']:>9.1f} "
+                  f"{r['cached_messages']:>11} {r['cached_members']:>9}")
+
+
+if __name__ == "__main__":
+    main()
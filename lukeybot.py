@@ -1,68 +1,358 @@
 import os
 import random
 import requests
+import urllib3
 import tempfile
+import glob
+import itertools
 import subprocess
 import shutil
 import logging
+import logging.handlers
+import queue
 import atexit
 import signal
 import sys
+import hashlib
+import time
+import asyncio
+import threading
+import json
+import weakref
+import traceback
+import heapq
+import bisect
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta, timezone
 
 import discord
+from discord import app_commands
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
 from typing import Optional
+from collections import OrderedDict
 
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
+
+try:
+    from PIL import Image, ImageOps, ImageSequence
+except ImportError:  # Pillow es opcional: sin él no hay backend Pillow ni variantes
+    Image = None
+    ImageOps = None
+    ImageSequence = None
 
 # ==========================
 # Configuración de Logging
 # ==========================
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-logger = logging.getLogger('lukeybot')
+# Los registros se encolan sin bloquear y un hilo aparte los formatea y escribe
+# en stdout y en un archivo rotativo: si stdout se atasca en el hosting, el
+# event loop no se entera. La configuración se lee aquí (antes que el resto)
+# porque el logging tiene que estar listo desde la primera línea.
+
+load_dotenv()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json o text
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # por logger: "discord=WARNING,lukeybot=DEBUG"
+LOG_FILE = os.getenv("LOG_FILE", os.path.join("logs", "lukeybot.log"))  # vacío = sin archivo
+LOG_FILE_MAX_MB = float(os.getenv("LOG_FILE_MAX_MB", "10"))
+LOG_FILE_BACKUPS = int(os.getenv("LOG_FILE_BACKUPS", "5"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_DEBUG_SAMPLE_EVERY = int(os.getenv("LOG_DEBUG_SAMPLE_EVERY", "1"))  # 1 = todos los DEBUG
+
+# Atributos propios de LogRecord; el resto viene de `extra=` y va al JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro, con los campos de `extra=` incluidos."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.levelno >= logging.WARNING:
+            entry["where"] = f"{record.module}:{record.funcName}:{record.lineno}"
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Formato de texto clásico con los campos de `extra=` como clave=valor."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        extras = " ".join(f"{k}={v}" for k, v in vars(record).items() if k not in _RECORD_ATTRS)
+        return f"{line} {extras}" if extras else line
+
+class DebugSampler(logging.Filter):
+    """Deja pasar 1 de cada `every` registros DEBUG por punto de llamada (siempre el primero)."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, every)
+        self._counts = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.DEBUG or self.every == 1:
+            return True
+        site = (record.pathname, record.lineno)
+        count = self._counts.get(site, 0)
+        self._counts[site] = count + 1
+        return count % self.every == 0
+
+# Espera máxima para encolar un aviso o error con la cola llena (los DEBUG/INFO no esperan)
+LOG_QUEUE_BLOCK_SECONDS = 0.1
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que no frena al que registra: con la cola llena descarta y lo cuenta.
+
+    Solo se descartan registros por debajo de WARNING; los avisos y errores
+    esperan un instante (LOG_QUEUE_BLOCK_SECONDS) a que el listener haga hueco.
+    El mensaje se formatea en el hilo del listener, no en el que registra.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=LOG_QUEUE_BLOCK_SECONDS)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _parse_log_levels(spec: str) -> dict:
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        if not level or not isinstance(logging.getLevelName(level.strip().upper()), int):
+            raise RuntimeError(f"LOG_LEVELS inválido: {item!r} (formato logger=NIVEL)")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging():
+    """Configura el pipeline de logging; devuelve el QueueHandler (para métricas)."""
+    if LOG_FORMAT not in ("json", "text"):
+        raise RuntimeError(f"LOG_FORMAT inválido: {LOG_FORMAT} (usa json o text)")
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+        handlers.append(logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=int(LOG_FILE_MAX_MB * 1024 * 1024),
+            backupCount=LOG_FILE_BACKUPS, encoding="utf-8",
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE_EVERY))
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    if os.getenv("DEBUG", "False").lower() == "true":
+        logging.getLogger("lukeybot").setLevel(logging.DEBUG)
+    for name, level in _parse_log_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener.start()
+
+    def stop_listener():
+        # Vacía la cola antes de salir; se registra primero para ejecutarse el último
+        if queue_handler.dropped:
+            logging.getLogger("lukeybot").warning("Logging: %d registros descartados por cola llena", queue_handler.dropped)
+        listener.stop()
 
-# Lista global para rastrear archivos temporales
-temp_files_to_cleanup = []
+    atexit.register(stop_listener)
+    return queue_handler
+
+log_queue_handler = setup_logging()
+logger = logging.getLogger('lukeybot')
 
 # ==========================
-# Limpieza de archivos temporales
+# Área de trabajo temporal (scratch)
 # ==========================
 
-def cleanup_temp_files():
-    """Limpia todos los archivos temporales al finalizar."""
-    logger.info(f"Limpiando {len(temp_files_to_cleanup)} archivos temporales...")
-    for filepath in temp_files_to_cleanup:
+class ScratchQuotaExceeded(OSError):
+    """El área de trabajo temporal no tiene cuota suficiente para otro archivo."""
+
+_UNTRACKED = object()
+
+class ScratchSpace:
+    """Archivos temporales del bot (descargas, intermedios de compresión...).
+
+    Todo vive en un directorio dedicado, opcionalmente en tmpfs (/dev/shm) o
+    respaldado por memfd: en ese modo el directorio solo contiene enlaces a
+    memoria anónima y los intermedios de ffmpeg nunca tocan el disco. El
+    registro y la liberación son O(1), hay una cuota total de bytes y al
+    arrancar se barren los restos que dejó un proceso anterior.
+    """
+
+    def __init__(self, directory: str, backing: str = "disk", quota_bytes: int = 0):
+        self.directory = directory
+        self.backing = backing
+        self.quota_bytes = quota_bytes
+        self._files = {}  # ruta -> (fd del memfd o None, bytes reservados)
+        self._lock = threading.Lock()
+        self._reserved_bytes = 0
+        self._counter = itertools.count()
+        self.created = 0
+        self.released = 0
+        self.swept = 0
+        self.quota_rejections = 0
+        self.peak_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def used_bytes(self) -> int:
+        """Bytes reservados por los archivos vivos (lo esperado al registrarlos)."""
+        with self._lock:
+            return self._reserved_bytes
+
+    def new_path(self, suffix: str = "", expected_bytes: int = 0) -> str:
+        """Reserva una ruta nueva y registrada. Lanza ScratchQuotaExceeded si no cabe."""
+        with self._lock:
+            used = self._reserved_bytes
+            if self.quota_bytes and used + expected_bytes > self.quota_bytes:
+                self.quota_rejections += 1
+                raise ScratchQuotaExceeded(
+                    f"Cuota de scratch superada ({used} + {expected_bytes} > {self.quota_bytes} bytes)"
+                )
+            self._reserved_bytes += expected_bytes
+            self.peak_bytes = max(self.peak_bytes, self._reserved_bytes)
+
+        path = os.path.join(self.directory, f"lb_{os.getpid()}_{next(self._counter)}{suffix}")
+        fd = None
         try:
-            if os.path.exists(filepath):
-                os.remove(filepath)
-                logger.debug(f"Eliminado: {filepath}")
-        except Exception as e:
-            logger.warning(f"No se pudo eliminar {filepath}: {e}")
-    temp_files_to_cleanup.clear()
+            if self.backing == "memfd":
+                fd = os.memfd_create(os.path.basename(path), os.MFD_CLOEXEC)
+                os.symlink(f"/proc/{os.getpid()}/fd/{fd}", path)
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            with self._lock:
+                self._reserved_bytes -= expected_bytes
+            raise
+        with self._lock:
+            self._files[path] = (fd, expected_bytes)
+            self.created += 1
+        return path
 
-def register_temp_file(filepath: str):
-    """Registra un archivo temporal para limpieza posterior."""
-    temp_files_to_cleanup.append(filepath)
+    def release(self, path: str):
+        """Elimina un archivo temporal y lo da de baja."""
+        try:
+            # Tamaño real (los memfd se miden a través del enlace) para que el pico no se quede corto
+            real = os.stat(path).st_size
+        except OSError:
+            real = 0
+        with self._lock:
+            fd, reserved = self._files.pop(path, (_UNTRACKED, 0))
+            if fd is not _UNTRACKED:
+                self.released += 1
+                self.peak_bytes = max(self.peak_bytes, self._reserved_bytes - reserved + real)
+                self._reserved_bytes -= reserved
+        try:
+            if os.path.lexists(path):
+                os.remove(path)
+                logger.debug("Limpiado inmediato: %s", path)
+        except OSError as e:
+            logger.warning(f"Error limpiando {path}: {e}")
+        if fd is not _UNTRACKED and fd is not None:
+            os.close(fd)
 
-def cleanup_temp_file(filepath: str):
-    """Limpia un archivo temporal inmediatamente."""
-    try:
-        if filepath in temp_files_to_cleanup:
-            temp_files_to_cleanup.remove(filepath)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            logger.debug(f"Limpiado inmediato: {filepath}")
-    except Exception as e:
-        logger.warning(f"Error limpiando {filepath}: {e}")
+    def release_all(self):
+        with self._lock:
+            paths = list(self._files)
+        if paths:
+            logger.info(f"Limpiando {len(paths)} archivos temporales...")
+        for path in paths:
+            self.release(path)
+
+    def sweep_stale(self, max_age_seconds: float):
+        """Borra restos de ejecuciones anteriores: archivos viejos y enlaces memfd rotos."""
+        now = time.time()
+        with self._lock:
+            live = set(self._files)
+        for entry in os.scandir(self.directory):
+            if entry.path in live:
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+                dangling = entry.is_symlink() and not os.path.exists(entry.path)
+                if dangling or now - st.st_mtime > max_age_seconds:
+                    os.remove(entry.path)
+                    self.swept += 1
+            except OSError as e:
+                logger.debug("No se pudo barrer %s: %s", entry.path, e)
+        if self.swept:
+            logger.info(f"Scratch: barridos {self.swept} archivos huérfanos de {self.directory}")
+
+    def metrics(self) -> dict:
+        used = self.used_bytes()
+        with self._lock:
+            live = len(self._files)
+        return {
+            "backing": self.backing,
+            "directory": self.directory,
+            "live_files": live,
+            "reserved_bytes": used,
+            "peak_bytes": self.peak_bytes,
+            "quota_bytes": self.quota_bytes,
+            "created": self.created,
+            "released": self.released,
+            "swept": self.swept,
+            "quota_rejections": self.quota_rejections,
+        }
+
+def sweep_legacy_temp_files(max_age_seconds: float):
+    """Restos de versiones anteriores, que escribían directamente en el tmp del sistema."""
+    now = time.time()
+    patterns = ("tmp*_palette.png", "tmp*_compressed.gif", "tmp*_gifsicle.gif", "tmp*_pillow.gif", "tmp*_variant.*")
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(tempfile.gettempdir(), pattern)):
+            try:
+                if now - os.path.getmtime(path) > max_age_seconds:
+                    os.remove(path)
+                    logger.info(f"Eliminado temporal huérfano: {path}")
+            except OSError:
+                pass
+
+def cleanup_temp_files():
+    """Limpia todos los archivos temporales al finalizar."""
+    if "scratch" in globals():
+        scratch.release_all()
+        logger.info("Scratch", extra={"metrics": scratch.metrics()})
+    if "work_scheduler" in globals():
+        logger.info("Planificador", extra={"metrics": work_scheduler.metrics()})
+    if "TRANSCODERS" in globals():
+        logger.info("Transcoders", extra={"metrics": transcoder_metrics()})
+    if "loop_watchdog" in globals() and loop_watchdog.running:
+        logger.info("Lag del event loop", extra={"metrics": loop_watchdog.metrics()})
 
 def signal_handler(sig, frame):
     """Maneja señales de terminación para limpiar antes de salir."""
@@ -80,7 +370,6 @@ signal.signal(signal.SIGTERM, signal_handler)
 # ==========================
 
 
-load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 DRIVE_FOLDER_ID = os.getenv("DRIVE_FOLDER_ID")
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE")
@@ -88,32 +377,183 @@ SERVICE_ACCOUNT_JSON = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")  # JSON como str
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 MAX_GIF_MB = int(os.getenv("MAX_GIF_MB", "50"))  # configurable via .env
 MAX_GIF_SIZE_BYTES = MAX_GIF_MB * 1024 * 1024
-DISCORD_MAX_MB = int(os.getenv("DISCORD_MAX_MB", "8"))
+DISCORD_MAX_MB = int(os.getenv("DISCORD_MAX_MB", "8"))  # límite para DMs y destinos sin servidor
 DISCORD_MAX_BYTES = DISCORD_MAX_MB * 1024 * 1024
+UPLOAD_LIMIT_PER_GUILD = os.getenv("UPLOAD_LIMIT_PER_GUILD", "True").lower() == "true"
 AUTO_POST_CHANNEL_ID = os.getenv("AUTO_POST_CHANNEL_ID")  # ID del canal para auto-post cada 6h
 KCD_POST_CHANNEL_ID = os.getenv("KCD_POST_CHANNEL_ID")  # ID del canal para auto-post cada 8h
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "4"))
+DOWNLOAD_BACKOFF_SECONDS = float(os.getenv("DOWNLOAD_BACKOFF_SECONDS", "1"))
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", "10"))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", "30"))
+STREAM_TRANSCODE = os.getenv("STREAM_TRANSCODE", "True").lower() == "true"  # comprimir mientras se descarga
+STREAM_TRANSCODE_TIMEOUT = float(os.getenv("STREAM_TRANSCODE_TIMEOUT", "60"))
+PILLOW_MAX_MEGAPIXELS = float(os.getenv("PILLOW_MAX_MEGAPIXELS", "200"))  # frames × área por intento de Pillow
+PROGRESSIVE_DELIVERY = os.getenv("PROGRESSIVE_DELIVERY", "True").lower() == "true"  # vista previa si tarda
+PROGRESSIVE_DELAY_MS = int(os.getenv("PROGRESSIVE_DELAY_MS", "1000"))  # espera antes de enviar la vista previa
+PROGRESSIVE_CUTOFF_SECONDS = float(os.getenv("PROGRESSIVE_CUTOFF_SECONDS", "60"))  # luego la vista previa se queda
+DRIVE_HTTP_TIMEOUT = float(os.getenv("DRIVE_HTTP_TIMEOUT", "15"))
+DRIVE_CALL_DEADLINE_SECONDS = float(os.getenv("DRIVE_CALL_DEADLINE_SECONDS", "30"))
+DRIVE_BACKOFF_SECONDS = float(os.getenv("DRIVE_BACKOFF_SECONDS", "0.5"))
+DRIVE_BACKOFF_MAX_SECONDS = float(os.getenv("DRIVE_BACKOFF_MAX_SECONDS", "8"))
+DRIVE_BREAKER_THRESHOLD = int(os.getenv("DRIVE_BREAKER_THRESHOLD", "5"))
+DRIVE_BREAKER_RESET_SECONDS = float(os.getenv("DRIVE_BREAKER_RESET_SECONDS", "60"))
+DEDUP_SELECTION = os.getenv("DEDUP_SELECTION", "True").lower() == "true"  # duplicados cuentan como uno
+CATALOG_TTL_SECONDS = float(os.getenv("CATALOG_TTL_SECONDS", "300"))
+CATALOG_REFRESH_JITTER = float(os.getenv("CATALOG_REFRESH_JITTER", "0.2"))  # fracción del TTL
+CATALOG_POOL_MAX_FILES = int(os.getenv("CATALOG_POOL_MAX_FILES", "1000000"))  # entre todas las carpetas
+CATALOG_POOL_MB = float(os.getenv("CATALOG_POOL_MB", "64"))
+GUILD_FOLDERS_FILE = os.getenv("GUILD_FOLDERS_FILE", "guild_folders.json")
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "lukeybot_cache"))
+MEDIA_CACHE_MB = int(os.getenv("MEDIA_CACHE_MB", "500"))
+LOW_MEMORY_MODE = os.getenv("LOW_MEMORY_MODE", "False").lower() == "true"
+LOW_MEMORY_MESSAGE_CACHE = int(os.getenv("LOW_MEMORY_MESSAGE_CACHE", "0"))  # 0 = sin caché de mensajes
+COMMAND_MODE = os.getenv("COMMAND_MODE", "prefix").lower()  # prefix, slash o both
+SLASH_SYNC_GUILD_ID = os.getenv("SLASH_SYNC_GUILD_ID")  # sincronizar en un servidor (más rápido al probar)
+AUTO_POST_SCHEDULES_FILE = os.getenv("AUTO_POST_SCHEDULES_FILE", "schedules.json")
+SCHEDULE_JITTER_SECONDS = float(os.getenv("SCHEDULE_JITTER_SECONDS", "300"))
+SCHEDULE_TICK_SECONDS = int(os.getenv("SCHEDULE_TICK_SECONDS", "60"))  # ventana de agrupación
+FANOUT_RATE_PER_SECOND = float(os.getenv("FANOUT_RATE_PER_SECOND", "25"))
+WORK_CONCURRENCY = int(os.getenv("WORK_CONCURRENCY", "4"))  # descargas/compresiones simultáneas
+DEGRADE_QUEUE_DEPTH = int(os.getenv("DEGRADE_QUEUE_DEPTH", "4"))
+DEGRADE_WAIT_SECONDS = float(os.getenv("DEGRADE_WAIT_SECONDS", "5"))
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", "10"))
+SHED_WAIT_SECONDS = float(os.getenv("SHED_WAIT_SECONDS", "20"))
+LOOP_WATCHDOG = os.getenv("LOOP_WATCHDOG", "True").lower() == "true"
+LOOP_WATCHDOG_INTERVAL_MS = int(os.getenv("LOOP_WATCHDOG_INTERVAL_MS", "100"))
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))  # captura la pila a partir de aquí
+SCRATCH_BACKING = os.getenv("SCRATCH_BACKING", "auto").lower()  # auto, disk, tmpfs o memfd
+SCRATCH_DIR = os.getenv("SCRATCH_DIR")  # por defecto depende del backing
+SCRATCH_QUOTA_MB = int(os.getenv("SCRATCH_QUOTA_MB", "512"))  # 0 = sin cuota
+SCRATCH_QUOTA_BYTES = SCRATCH_QUOTA_MB * 1024 * 1024
+SCRATCH_STALE_MINUTES = int(os.getenv("SCRATCH_STALE_MINUTES", "30"))
+IMAGE_VARIANT_MAX_DIM = int(os.getenv("IMAGE_VARIANT_MAX_DIM", "1600"))  # lado máximo en px
+IMAGE_VARIANT_THRESHOLD_KB = int(os.getenv("IMAGE_VARIANT_THRESHOLD_KB", "1024"))
+IMAGE_VARIANT_THRESHOLD_BYTES = IMAGE_VARIANT_THRESHOLD_KB * 1024
+IMAGE_VARIANT_FORMAT = os.getenv("IMAGE_VARIANT_FORMAT", "webp").lower()  # webp o jpeg
+IMAGE_VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "82"))
+
+# Subcomando de línea de órdenes (p. ej. `python lukeybot.py precompute`); sin él se arranca el bot
+CLI_COMMAND = sys.argv[1] if __name__ == "__main__" and len(sys.argv) > 1 else None
 
-if not DISCORD_TOKEN:
+if not DISCORD_TOKEN and CLI_COMMAND != "precompute":
     logger.error("Falta DISCORD_TOKEN en el archivo .env")
     raise RuntimeError("Falta DISCORD_TOKEN en el archivo .env")
-if not DRIVE_FOLDER_ID:
-    logger.error("Falta DRIVE_FOLDER_ID en el archivo .env")
-    raise RuntimeError("Falta DRIVE_FOLDER_ID en el archivo .env")
+if IMAGE_VARIANT_FORMAT not in ("webp", "jpeg"):
+    logger.error("IMAGE_VARIANT_FORMAT debe ser 'webp' o 'jpeg'")
+    raise RuntimeError("IMAGE_VARIANT_FORMAT debe ser 'webp' o 'jpeg'")
+if COMMAND_MODE not in ("prefix", "slash", "both"):
+    logger.error("COMMAND_MODE debe ser 'prefix', 'slash' o 'both'")
+    raise RuntimeError("COMMAND_MODE debe ser 'prefix', 'slash' o 'both'")
+if SCRATCH_BACKING not in ("auto", "disk", "tmpfs", "memfd"):
+    logger.error("SCRATCH_BACKING debe ser 'auto', 'disk', 'tmpfs' o 'memfd'")
+    raise RuntimeError("SCRATCH_BACKING debe ser 'auto', 'disk', 'tmpfs' o 'memfd'")
 if not SERVICE_ACCOUNT_FILE and not SERVICE_ACCOUNT_JSON:
     logger.error("Falta GOOGLE_SERVICE_ACCOUNT_FILE o GOOGLE_SERVICE_ACCOUNT_JSON en el archivo .env")
     raise RuntimeError("Falta GOOGLE_SERVICE_ACCOUNT_FILE o GOOGLE_SERVICE_ACCOUNT_JSON en el archivo .env")
 
-logger.info(f"Configuración cargada: MAX_GIF_MB={MAX_GIF_MB}, DISCORD_MAX_MB={DISCORD_MAX_MB}, DEBUG={DEBUG}")
+logger.info(f"Configuración cargada: MAX_GIF_MB={MAX_GIF_MB}, DISCORD_MAX_MB={DISCORD_MAX_MB}, DEBUG={DEBUG}, COMMAND_MODE={COMMAND_MODE}, LOW_MEMORY_MODE={LOW_MEMORY_MODE}")
+
+# ==========================
+# Inicializar área de trabajo temporal
+# ==========================
+
+def _mount_fstype(path: str) -> Optional[str]:
+    """Tipo de sistema de archivos que contiene `path` según /proc/mounts (None si no se sabe)."""
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace("\\040", " ")
+                inside = path == mount or path.startswith(mount.rstrip("/") + "/")
+                if inside and len(mount) >= len(best):
+                    best, fstype = mount, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+def _resolve_scratch_backing(backing: str, directory: Optional[str] = None) -> tuple:
+    """Devuelve (backing efectivo, directorio base) según lo pedido y lo disponible.
+
+    Con SCRATCH_DIR el directorio lo fija el usuario: el backing se deduce de
+    dónde está montado en vez de suponer /dev/shm o el tmp del sistema.
+    """
+    if directory and backing != "memfd":
+        fstype = _mount_fstype(directory)
+        effective = "tmpfs" if fstype in ("tmpfs", "ramfs") else "disk"
+        if backing == "tmpfs" and effective != "tmpfs":
+            logger.warning(f"SCRATCH_DIR={directory} no está en tmpfs ({fstype or 'desconocido'}), usando disco")
+        return effective, directory
+    if backing == "memfd":
+        if hasattr(os, "memfd_create"):
+            return "memfd", directory or tempfile.gettempdir()
+        logger.warning("memfd no disponible en este sistema, usando tmpfs/disco para scratch")
+        if directory:
+            return _resolve_scratch_backing("auto", directory)
+        backing = "auto"
+    if backing in ("auto", "tmpfs") and os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        st = os.statvfs("/dev/shm")
+        # En auto solo se usa tmpfs si cabe la cuota entera (en Docker /dev/shm suele ser 64 MB)
+        if backing == "tmpfs" or st.f_bavail * st.f_frsize >= SCRATCH_QUOTA_BYTES:
+            return "tmpfs", "/dev/shm"
+    if backing == "tmpfs":
+        logger.warning("/dev/shm no disponible, usando disco para scratch")
+    return "disk", tempfile.gettempdir()
+
+_scratch_backing, _scratch_base = _resolve_scratch_backing(SCRATCH_BACKING, SCRATCH_DIR)
+scratch = ScratchSpace(
+    SCRATCH_DIR or os.path.join(_scratch_base, "lukeybot_scratch"),
+    backing=_scratch_backing,
+    quota_bytes=SCRATCH_QUOTA_BYTES,
+)
+scratch.sweep_stale(SCRATCH_STALE_MINUTES * 60)
+sweep_legacy_temp_files(SCRATCH_STALE_MINUTES * 60)
+logger.info(f"Scratch en {scratch.directory} ({scratch.backing}, cuota {SCRATCH_QUOTA_MB} MB)")
 
 # ==========================
 # Configuración Discord
 # ==========================
 
-intents = discord.Intents.default()
-intents.message_content = True  # MUY IMPORTANTE
+def build_gateway_options(low_memory: bool, command_mode: str) -> dict:
+    """Intents y cachés del cliente de Discord según el modo de memoria y de comandos.
+
+    En modo de baja memoria solo se pide lo imprescindible: `guilds` (caché de
+    canales para los auto-posts) y, si hay comandos con "!", los mensajes con su
+    contenido. Sin caché de mensajes (o acotada), sin chunking de miembros al
+    arrancar y sin cachear miembros.
+    """
+    uses_prefix = command_mode in ("prefix", "both")
+    if low_memory:
+        intents = discord.Intents.none()
+        intents.guilds = True
+        if uses_prefix:
+            intents.messages = True
+            intents.message_content = True
+        return {
+            "intents": intents,
+            "max_messages": LOW_MEMORY_MESSAGE_CACHE or None,
+            "chunk_guilds_at_startup": False,
+            "member_cache_flags": discord.MemberCacheFlags.none(),
+        }
+
+    intents = discord.Intents.default()
+    if uses_prefix:
+        intents.message_content = True  # MUY IMPORTANTE para los comandos con "!"
+    else:
+        # Solo interacciones: no hace falta recibir los mensajes de los servidores
+        intents.message_content = False
+        intents.messages = False
+    return {"intents": intents}
+
+gateway_options = build_gateway_options(LOW_MEMORY_MODE, COMMAND_MODE)
+intents = gateway_options["intents"]
 
 bot_name = "LukeyBot"
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+bot = commands.Bot(command_prefix="!", help_command=None, **gateway_options)
 # Asegurar que el comando por defecto 'help' esté eliminado
 try:
     bot.remove_command('help')
@@ -234,61 +674,760 @@ SPICY_QUOTES = [
 
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 
+# Errores HTTP de Drive que merecen reintento (403 solo si es por rate limit)
+DRIVE_RETRIABLE_STATUS = {429, 500, 502, 503, 504}
+DRIVE_RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+class CircuitOpenError(Exception):
+    """Drive está degradado y el circuit breaker no deja pasar la llamada."""
+
+class CircuitBreaker:
+    """Corta las llamadas a un servicio tras varios fallos seguidos.
+
+    closed -> open tras `failure_threshold` fallos; pasados `reset_seconds`
+    pasa a half_open y deja pasar una sola llamada de prueba: si va bien se
+    cierra, si falla vuelve a abrirse.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def degraded(self) -> bool:
+        return self.state != "closed"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info(f"Circuit breaker {self.name}: cerrado, servicio recuperado")
+            self.state = "closed"
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """Libera la llamada de prueba cuando falló antes de llegar al servicio (sin resultado)."""
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                logger.warning(f"Circuit breaker {self.name}: abierto tras {self.failures} fallos, pausa de {self.reset_seconds:.0f}s")
+
+drive_breaker = CircuitBreaker("drive", DRIVE_BREAKER_THRESHOLD, DRIVE_BREAKER_RESET_SECONDS)
+
+def _load_drive_credentials():
+    # Priorizar JSON desde variable de entorno (para Railway)
+    if SERVICE_ACCOUNT_JSON:
+        service_account_info = json.loads(SERVICE_ACCOUNT_JSON)
+        return service_account.Credentials.from_service_account_info(
+            service_account_info, scopes=SCOPES
+        )
+    if SERVICE_ACCOUNT_FILE:
+        return service_account.Credentials.from_service_account_file(
+            SERVICE_ACCOUNT_FILE, scopes=SCOPES
+        )
+    raise ValueError("No se encontró configuración de Service Account")
+
+# httplib2 no es thread-safe: un cliente de Drive por hilo
+_drive_local = threading.local()
+
 def get_drive_service():
+    service = getattr(_drive_local, "service", None)
+    if service is not None:
+        return service
     try:
-        # Priorizar JSON desde variable de entorno (para Railway)
-        if SERVICE_ACCOUNT_JSON:
-            import json
-            service_account_info = json.loads(SERVICE_ACCOUNT_JSON)
-            creds = service_account.Credentials.from_service_account_info(
-                service_account_info, scopes=SCOPES
-            )
-        elif SERVICE_ACCOUNT_FILE:
-            creds = service_account.Credentials.from_service_account_file(
-                SERVICE_ACCOUNT_FILE, scopes=SCOPES
-            )
-        else:
-            raise ValueError("No se encontró configuración de Service Account")
-        
-        return build("drive", "v3", credentials=creds)
+        http = AuthorizedHttp(_load_drive_credentials(), http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+        service = build("drive", "v3", http=http, cache_discovery=False)
     except Exception as e:
         logger.error(f"Error conectando con Google Drive: {e}")
         raise
+    _drive_local.service = service
+    return service
 
-def get_all_media_files_from_folder():
-    try:
-        service = get_drive_service()
-
-        query = (
-            f"'{DRIVE_FOLDER_ID}' in parents and ("
-            "mimeType = 'image/jpeg' or "
-            "mimeType = 'image/png' or "
-            "mimeType = 'image/gif'"
-            ") and trashed = false"
-        )
+def _is_retriable_drive_error(error: Exception) -> bool:
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status in DRIVE_RETRIABLE_STATUS:
+            return True
+        if status == 403:
+            reasons = {d.get("reason") for d in (error.error_details or []) if isinstance(d, dict)}
+            return bool(reasons & DRIVE_RATE_LIMIT_REASONS)
+        return False
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
 
-        files = []
-        page_token = None
+def drive_call(make_request, description: str, deadline: float = None):
+    """Ejecuta `make_request().execute()` con backoff exponencial con jitter,
+    un deadline total y el circuit breaker de Drive."""
+    if not drive_breaker.allow():
+        raise CircuitOpenError(f"Drive degradado, no se intenta {description}")
 
-        while True:
-            response = service.files().list(
+    deadline = DRIVE_CALL_DEADLINE_SECONDS if deadline is None else deadline
+    end = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        try:
+            result = make_request().execute()
+            drive_breaker.record_success()
+            return result
+        except Exception as e:
+            if not _is_retriable_drive_error(e):
+                # Drive respondió (p. ej. 404): el servicio está sano aunque la llamada falle
+                drive_breaker.record_success()
+                raise
+            attempt += 1
+            delay = min(DRIVE_BACKOFF_MAX_SECONDS, DRIVE_BACKOFF_SECONDS * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            if time.monotonic() + delay >= end:
+                drive_breaker.record_failure()
+                raise
+            logger.warning(f"Drive {description}: error transitorio ({e}), reintento {attempt} en {delay:.1f}s")
+            time.sleep(delay)
+
+def list_folder_media(folder_id: str) -> list:
+    """Lista las imágenes/GIFs de una carpeta de Drive (todas las páginas)."""
+    service = get_drive_service()
+
+    query = (
+        f"'{folder_id}' in parents and ("
+        "mimeType = 'image/jpeg' or "
+        "mimeType = 'image/png' or "
+        "mimeType = 'image/gif'"
+        ") and trashed = false"
+    )
+
+    files = []
+    page_token = None
+
+    while True:
+        response = drive_call(
+            lambda: service.files().list(
                 q=query,
                 spaces="drive",
-                fields="nextPageToken, files(id, name, mimeType)",
+                fields="nextPageToken, files(id, name, mimeType, size, md5Checksum, imageMediaMetadata(width, height))",
                 pageToken=page_token,
-            ).execute()
+            ),
+            f"listado de {folder_id}",
+        )
 
-            files.extend(response.get("files", []))
-            page_token = response.get("nextPageToken")
+        files.extend(response.get("files", []))
+        page_token = response.get("nextPageToken")
 
-            if not page_token:
-                break
+        if not page_token:
+            break
+
+    return files
+
+# ==========================
+# Catálogo (caché del listado de Drive)
+# ==========================
+# El listado se cachea CATALOG_TTL_SECONDS y se guarda en disco. Si Drive
+# falla o el breaker está abierto se sirve el último catálogo conocido.
+#
+# Cada servidor (y cada comando) puede usar su propia carpeta, configurada en
+# GUILD_FOLDERS_FILE. Ejemplo:
+#
+#   {
+#     "default": "<carpeta por defecto>",
+#     "commands": {"spicyluke": "<carpeta spicy para todos>"},
+#     "guilds": {
+#       "123456789012345678": {"folder": "<carpeta>", "commands": {"kcd": "<carpeta>"}}
+#     }
+#   }
+#
+# Las claves de `commands` son nombres de comando o de programación de
+# auto-post. Los catálogos se construyen al primer uso y comparten un pool LRU
+# acotado por número de archivos y memoria.
+
+class FolderConfig:
+    """Carpeta de Drive para cada servidor y comando.
+
+    Orden: comando del servidor, carpeta del servidor, comando global,
+    `default` del archivo y por último DRIVE_FOLDER_ID. El archivo se relee
+    cuando cambia.
+    """
+
+    RELOAD_CHECK_SECONDS = 10
+
+    def __init__(self, path: str, fallback: Optional[str]):
+        self.path = path
+        self.fallback = fallback
+        self.default = fallback
+        self._commands = {}
+        self._guilds = {}
+        self._mtime = None
+        self._checked = 0.0
+        self._load(strict=True)
+
+    @staticmethod
+    def _parse(data: dict) -> tuple:
+        if not isinstance(data, dict):
+            raise ValueError("se esperaba un objeto JSON")
+        commands = {str(k): str(v) for k, v in (data.get("commands") or {}).items()}
+        guilds = {}
+        for guild_id, entry in (data.get("guilds") or {}).items():
+            if isinstance(entry, str):
+                entry = {"folder": entry}
+            guilds[str(int(guild_id))] = {
+                "folder": entry.get("folder"),
+                "commands": {str(k): str(v) for k, v in (entry.get("commands") or {}).items()},
+            }
+        return data.get("default"), commands, guilds
+
+    def _load(self, strict: bool = False):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            if self._mtime is not None:
+                logger.warning(f"{self.path} ya no existe: se usa solo la carpeta por defecto")
+                self.default, self._commands, self._guilds, self._mtime = self.fallback, {}, {}, None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                default, commands, guilds = self._parse(json.load(f))
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            if strict:
+                raise RuntimeError(f"{self.path} inválido: {e}")
+            logger.error(f"{self.path} inválido, se mantiene la configuración anterior: {e}")
+            self._mtime = mtime
+            return
+        self.default = default or self.fallback
+        self._commands, self._guilds, self._mtime = commands, guilds, mtime
+        logger.info(f"Carpetas por servidor: {len(guilds)} servidores, {len(commands)} comandos globales")
+
+    def resolve(self, guild_id: Optional[int], command: str) -> Optional[str]:
+        now = time.monotonic()
+        if now - self._checked >= self.RELOAD_CHECK_SECONDS:
+            self._checked = now
+            self._load()
+        entry = self._guilds.get(str(guild_id)) if guild_id is not None else None
+        if entry:
+            folder = entry["commands"].get(command) or entry["folder"]
+            if folder:
+                return folder
+        return self._commands.get(command) or self.default
+
+    def folders(self) -> set:
+        """Todas las carpetas configuradas."""
+        found = {self.default} if self.default else set()
+        found.update(self._commands.values())
+        for entry in self._guilds.values():
+            if entry["folder"]:
+                found.add(entry["folder"])
+            found.update(entry["commands"].values())
+        return found
+
+folder_config = FolderConfig(GUILD_FOLDERS_FILE, DRIVE_FOLDER_ID)
+if not folder_config.default:
+    logger.error("Falta DRIVE_FOLDER_ID en el archivo .env (o 'default' en GUILD_FOLDERS_FILE)")
+    raise RuntimeError("Falta DRIVE_FOLDER_ID en el archivo .env")
 
-        logger.info(f"Cargados {len(files)} archivos desde Drive")
+# --------------------------
+# Catálogo compacto
+# --------------------------
+# Con carpetas de cientos de miles de archivos, una lista de dicts de Drive
+# ocupa del orden de 1 KB por archivo. El catálogo guarda columnas: cadenas
+# concatenadas en un único buffer con offsets, md5 en binario, tipo MIME como
+# código de una tabla internada y tamaños/dimensiones en arrays. Los dicts se
+# construyen solo para los archivos sorteados.
+#
+# Índices: posiciones por (tipo MIME, cubo de tamaño). Un sorteo filtrado por
+# límite de GIF elige un cubo en proporción a su tamaño y una posición dentro
+# de él; solo el cubo que contiene el límite necesita comprobar el tamaño.
+
+class _StringColumn:
+    """Cadenas UTF-8 concatenadas con su tabla de offsets."""
+
+    __slots__ = ("_data", "_offsets")
+
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = array("I", [0])
+
+    def append(self, value: str):
+        self._data += value.encode("utf-8")
+        self._offsets.append(len(self._data))
+
+    def freeze(self):
+        self._data = bytes(self._data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, offsets: bytes) -> "_StringColumn":
+        column = cls()
+        column._data = data
+        column._offsets = array("I")
+        column._offsets.frombytes(offsets)
+        return column
+
+    def __getitem__(self, i: int) -> str:
+        return self._data[self._offsets[i]:self._offsets[i + 1]].decode("utf-8")
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._data) + self._offsets.itemsize * len(self._offsets)
+
+_NO_MD5 = bytes(16)
+_UNKNOWN_SIZE_BUCKET = -1
+
+def _size_bucket(size: int) -> int:
+    """Cubo de tamaño: cuatro por cada potencia de dos (monótono con el tamaño)."""
+    if size < 0:
+        return _UNKNOWN_SIZE_BUCKET
+    bits = size.bit_length()
+    return bits * 4 + ((size >> max(bits - 3, 0)) & 3 if bits >= 3 else 0)
+
+class MediaCatalog:
+    """Listado de una carpeta en columnas, con sorteos filtrados en O(1).
+
+    Se indexa como una secuencia de dicts con los campos de Drive (`id`,
+    `name`, `mimeType`, `size`, `md5Checksum`, `imageMediaMetadata`), creados
+    al acceder. Es inmutable: un refresco construye un catálogo nuevo.
+    """
+
+    GIF = "image/gif"
+
+    def __init__(self, files):
+        self._ids = _StringColumn()
+        self._names = _StringColumn()
+        self._md5 = bytearray()
+        self._sizes = array("q")
+        self._dims = array("I")  # ancho y alto intercalados; 0 si se desconoce
+        self._mime_codes = array("B")
+        self._mime_table = []
+        mime_index = {}
+        for f in files:
+            self._ids.append(f["id"])
+            self._names.append(f.get("name") or "")
+            md5 = f.get("md5Checksum")
+            self._md5 += bytes.fromhex(md5) if md5 else _NO_MD5
+            size = int(f["size"]) if f.get("size") else -1
+            self._sizes.append(size)
+            meta = f.get("imageMediaMetadata") or {}
+            self._dims.append(int(meta.get("width") or 0))
+            self._dims.append(int(meta.get("height") or 0))
+            mime = f.get("mimeType") or ""
+            code = mime_index.get(mime)
+            if code is None:
+                code = mime_index[mime] = len(self._mime_table)
+                self._mime_table.append(sys.intern(mime))
+            self._mime_codes.append(code)
+        self._freeze()
+
+    def _freeze(self):
+        """Cierra las columnas y construye los índices por (tipo MIME, cubo de tamaño)."""
+        self._ids.freeze()
+        self._names.freeze()
+        self._md5 = bytes(self._md5)
+        self._gif_code = self._mime_table.index(self.GIF) if self.GIF in self._mime_table else None
+        buckets = {}
+        sizes = self._sizes
+        for position, code in enumerate(self._mime_codes):
+            key = (code, _size_bucket(sizes[position]) if code == self._gif_code else 0)
+            positions = buckets.get(key)
+            if positions is None:
+                positions = buckets[key] = array("I")
+            positions.append(position)
+        self._index = buckets
+        self._plans = {}
+
+    # --- Persistencia: las columnas tal cual, tras una cabecera JSON ---
+
+    FORMAT_VERSION = 1
+
+    def _column_bytes(self) -> list:
+        return [self._ids._data, self._ids._offsets.tobytes(), self._names._data, self._names._offsets.tobytes(),
+                self._md5, self._sizes.tobytes(), self._dims.tobytes(), self._mime_codes.tobytes()]
+
+    def fingerprint(self) -> str:
+        """Huella del listado, para no reescribirlo en disco si no cambió."""
+        digest = hashlib.md5()
+        for blob in self._column_bytes():
+            digest.update(blob)
+        digest.update("\0".join(self._mime_table).encode("utf-8"))
+        return digest.hexdigest()
+
+    def save(self, path: str):
+        blobs = self._column_bytes()
+        header = {"version": self.FORMAT_VERSION, "byteorder": sys.byteorder,
+                  "mime_table": self._mime_table, "lengths": [len(b) for b in blobs]}
+        with open(path, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            for blob in blobs:
+                f.write(blob)
+
+    @classmethod
+    def load(cls, path: str) -> "MediaCatalog":
+        """Lee un catálogo guardado con `save`; ValueError si el archivo no es válido."""
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != cls.FORMAT_VERSION or header.get("byteorder") != sys.byteorder:
+                raise ValueError("formato de catálogo no soportado")
+            blobs = [f.read(n) for n in header["lengths"]]
+        if len(blobs) != 8 or any(len(b) != n for b, n in zip(blobs, header["lengths"])):
+            raise ValueError("catálogo truncado")
+        catalog = cls.__new__(cls)
+        catalog._ids = _StringColumn.from_bytes(blobs[0], blobs[1])
+        catalog._names = _StringColumn.from_bytes(blobs[2], blobs[3])
+        catalog._md5 = blobs[4]
+        catalog._sizes, catalog._dims, catalog._mime_codes = array("q"), array("I"), array("B")
+        for column, blob in zip((catalog._sizes, catalog._dims, catalog._mime_codes), blobs[5:]):
+            column.frombytes(blob)
+        catalog._mime_table = [sys.intern(m) for m in header["mime_table"]]
+        catalog._freeze()
+        return catalog
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def __getitem__(self, i: int) -> dict:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("posición fuera del catálogo")
+        record = {"id": self._ids[i], "name": self._names[i], "mimeType": self._mime_table[self._mime_codes[i]]}
+        if self._sizes[i] >= 0:
+            record["size"] = str(self._sizes[i])
+        md5 = self._md5[i * 16:i * 16 + 16]
+        if md5 != _NO_MD5:
+            record["md5Checksum"] = md5.hex()
+        width, height = self._dims[2 * i], self._dims[2 * i + 1]
+        if width or height:
+            record["imageMediaMetadata"] = {"width": width, "height": height}
+        return record
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self) -> int:
+        """Memoria aproximada de las columnas y los índices."""
+        arrays = [self._sizes, self._dims, self._mime_codes, *self._index.values()]
+        return (self._ids.nbytes + self._names.nbytes + len(self._md5)
+                + sum(a.itemsize * len(a) for a in arrays))
+
+    def _plan(self, max_gif_bytes: Optional[int]) -> tuple:
+        """Cubos candidatos para un límite de GIF: (cubos, acumulados, cubo a comprobar).
+
+        `max_gif_bytes` None admite cualquier GIF; 0 o menos, ninguno.
+        """
+        plan = self._plans.get(max_gif_bytes)
+        if plan is not None:
+            return plan
+        limit_bucket = _size_bucket(max_gif_bytes) if max_gif_bytes and max_gif_bytes > 0 else None
+        chosen, partial = [], None
+        for (code, bucket), positions in self._index.items():
+            if code != self._gif_code or max_gif_bytes is None:
+                chosen.append(positions)
+            elif limit_bucket is None:
+                continue
+            elif bucket == _UNKNOWN_SIZE_BUCKET or bucket < limit_bucket:
+                # Los de tamaño desconocido los comprueba quien llama (HEAD)
+                chosen.append(positions)
+            elif bucket == limit_bucket:
+                chosen.append(positions)
+                partial = positions
+        plan = (chosen, list(itertools.accumulate(len(p) for p in chosen)), partial)
+        if len(self._plans) < 64:
+            self._plans[max_gif_bytes] = plan
+        return plan
+
+    def candidates(self, max_gif_bytes: Optional[int] = None) -> int:
+        """Cota superior de los archivos que admite el filtro (sin contar el cubo parcial)."""
+        chosen, cumulative, _ = self._plan(max_gif_bytes)
+        return cumulative[-1] if cumulative else 0
+
+    def draw_position(self, max_gif_bytes: Optional[int] = None, attempts: int = 10) -> Optional[int]:
+        """Posición aleatoria uniforme entre los archivos que admite el filtro, o None."""
+        chosen, cumulative, partial = self._plan(max_gif_bytes)
+        if not cumulative:
+            return None
+        for _ in range(attempts):
+            r = random.randrange(cumulative[-1])
+            k = bisect.bisect_right(cumulative, r)
+            positions = chosen[k]
+            position = positions[r - (cumulative[k - 1] if k else 0)]
+            if positions is not partial or self._sizes[position] <= max_gif_bytes:
+                return position
+        return None
+
+    def draw(self, max_gif_bytes: Optional[int] = None, attempts: int = 10) -> Optional[dict]:
+        position = self.draw_position(max_gif_bytes, attempts)
+        return None if position is None else self[position]
+
+    def admits(self, position: int, max_gif_bytes: Optional[int]) -> bool:
+        """Si el filtro de sorteo admite la posición (los GIF de tamaño desconocido, sí)."""
+        if self._mime_codes[position] != self._gif_code or max_gif_bytes is None:
+            return True
+        if max_gif_bytes <= 0:
+            return False
+        return self._sizes[position] <= max_gif_bytes
+
+    def positions(self, max_gif_bytes: Optional[int] = None):
+        """Todas las posiciones que admite el filtro (para recorridos completos)."""
+        chosen, _, partial = self._plan(max_gif_bytes)
+        for positions in chosen:
+            for position in positions:
+                if positions is not partial or self._sizes[position] <= max_gif_bytes:
+                    yield position
+
+class CatalogView:
+    """Subconjunto de un MediaCatalog (array de posiciones) con la misma interfaz de sorteo.
+
+    Las posiciones que devuelven `draw_position` y `positions` son índices de la vista.
+    """
+
+    def __init__(self, catalog: MediaCatalog, positions: array):
+        self.catalog = catalog
+        self._positions = positions
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __getitem__(self, i: int) -> dict:
+        return self.catalog[self._positions[i]]
+
+    def __iter__(self):
+        for position in self._positions:
+            yield self.catalog[position]
+
+    def candidates(self, max_gif_bytes: Optional[int] = None) -> int:
+        return sum(1 for p in self._positions if self.catalog.admits(p, max_gif_bytes))
+
+    def draw_position(self, max_gif_bytes: Optional[int] = None, attempts: int = 10) -> Optional[int]:
+        if not self._positions:
+            return None
+        for _ in range(attempts):
+            i = random.randrange(len(self._positions))
+            if self.catalog.admits(self._positions[i], max_gif_bytes):
+                return i
+        return None
+
+    def draw(self, max_gif_bytes: Optional[int] = None, attempts: int = 10) -> Optional[dict]:
+        i = self.draw_position(max_gif_bytes, attempts)
+        return None if i is None else self[i]
+
+    def positions(self, max_gif_bytes: Optional[int] = None):
+        for i, position in enumerate(self._positions):
+            if self.catalog.admits(position, max_gif_bytes):
+                yield i
+
+class CatalogPool:
+    """Catálogos de todas las carpetas, con LRU por número total de archivos y memoria.
+
+    Cada entrada guarda su instante de caducidad, con un desfase aleatorio
+    para que las carpetas no se refresquen todas a la vez.
+    """
+
+    def __init__(self, max_files: int, max_bytes: int):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # folder_id -> (caduca monotonic, MediaCatalog, bytes)
+        self._files = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, folder_id: str) -> Optional[tuple]:
+        """Devuelve (caduca, archivos) o None, marcándolo como usado."""
+        with self._lock:
+            entry = self._entries.get(folder_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(folder_id)
+            return entry[0], entry[1]
+
+    def put(self, folder_id: str, files: MediaCatalog, expires: float):
+        size = files.nbytes
+        with self._lock:
+            self._drop(folder_id)
+            self._entries[folder_id] = (expires, files, size)
+            self._files += len(files)
+            self._bytes += size
+            # El recién cargado se queda aunque por sí solo supere los límites
+            while len(self._entries) > 1 and (self._files > self.max_files or self._bytes > self.max_bytes):
+                evicted = next(iter(self._entries))
+                self._drop(evicted)
+                self.evictions += 1
+                logger.debug("Catálogo de %s expulsado del pool", evicted)
+
+    def _drop(self, folder_id: str):
+        entry = self._entries.pop(folder_id, None)
+        if entry:
+            self._files -= len(entry[1])
+            self._bytes -= entry[2]
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "folders": len(self._entries),
+                "files": self._files,
+                "approx_mb": round(self._bytes / 1024 / 1024, 1),
+                "evictions": self.evictions,
+            }
+
+catalog_pool = CatalogPool(CATALOG_POOL_MAX_FILES, int(CATALOG_POOL_MB * 1024 * 1024))
+# Un refresco a la vez por carpeta
+_catalog_refresh_locks = {}
+_catalog_refresh_guard = threading.Lock()
+
+def _catalog_refresh_lock(folder_id: str) -> threading.Lock:
+    with _catalog_refresh_guard:
+        return _catalog_refresh_locks.setdefault(folder_id, threading.Lock())
+
+def _catalog_expiry() -> float:
+    return time.monotonic() + CATALOG_TTL_SECONDS * (1 + random.uniform(0, CATALOG_REFRESH_JITTER))
+
+def _catalog_dir() -> str:
+    return os.path.join(MEDIA_CACHE_DIR, "catalog")
+
+def _catalog_state_path(folder_id: str) -> str:
+    return os.path.join(_catalog_dir(), f"{folder_id}.catalog")
+
+# Huella de lo último escrito por carpeta: un refresco sin cambios no toca el disco
+_saved_catalog_fingerprints = {}
+
+def _save_catalog(folder_id: str, catalog: MediaCatalog):
+    fingerprint = catalog.fingerprint()
+    if _saved_catalog_fingerprints.get(folder_id) == fingerprint:
+        return
+    path = _catalog_state_path(folder_id)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        catalog.save(tmp)
+        os.replace(tmp, path)
+        _saved_catalog_fingerprints[folder_id] = fingerprint
+        _prune_saved_catalogs()
+    except OSError as e:
+        logger.warning(f"No se pudo guardar el catálogo de {folder_id}: {e}")
+
+def _prune_saved_catalogs():
+    """Borra los catálogos de carpetas que ya no están configuradas (y los JSON del formato anterior)."""
+    folders = folder_config.folders()
+    keep = {os.path.basename(_catalog_state_path(f)) for f in folders}
+    directory = _catalog_dir()
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        if name in keep or ext == ".tmp":
+            continue
+        if ext == ".json" and stem in folders and not os.path.exists(_catalog_state_path(stem)):
+            continue  # formato anterior aún sin reemplazar: sigue sirviendo de respaldo
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+def _load_saved_catalog(folder_id: str) -> Optional[MediaCatalog]:
+    try:
+        return MediaCatalog.load(_catalog_state_path(folder_id))
+    except (OSError, ValueError, KeyError):
+        pass
+    # Formato anterior: lista de dicts en JSON
+    try:
+        with open(os.path.join(_catalog_dir(), f"{folder_id}.json"), encoding="utf-8") as f:
+            return MediaCatalog(_selection_view(json.load(f)))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def media_key(file: dict) -> str:
+    """Identidad del contenido: el md5 de Drive (compartido por copias idénticas) o el id."""
+    return file.get("md5Checksum") or file["id"]
+
+def group_duplicates(files: list) -> dict:
+    """Agrupa los archivos por contenido: media_key -> lista de archivos."""
+    groups = {}
+    for f in files:
+        groups.setdefault(media_key(f), []).append(f)
+    return groups
+
+def _selection_view(files: list) -> list:
+    """Lista sobre la que se sortea: con DEDUP_SELECTION, un representante por grupo."""
+    if not DEDUP_SELECTION:
         return files
-    except Exception as e:
-        logger.error(f"Error obteniendo archivos de Drive: {e}")
-        return []
+    seen = set()
+    unique = []
+    for f in files:
+        key = media_key(f)
+        if key not in seen:
+            seen.add(key)
+            unique.append(f)
+    if len(unique) != len(files):
+        logger.info(f"Catálogo: {len(files)} archivos, {len(unique)} únicos por md5")
+    return unique
+
+def _stale_catalog(folder_id: str) -> MediaCatalog:
+    cached = catalog_pool.get(folder_id)
+    if cached:
+        return cached[1]
+    saved = _load_saved_catalog(folder_id)
+    if saved:
+        # Guardado como caducado para que se intente refrescar en cuanto Drive vuelva
+        catalog_pool.put(folder_id, saved, float("-inf"))
+        logger.info(f"Catálogo de {folder_id} recuperado de disco ({len(saved)} archivos)")
+        return saved
+    return MediaCatalog(())
+
+def get_all_media_files_from_folder(folder_id: Optional[str] = None) -> MediaCatalog:
+    """Catálogo de `folder_id` (por defecto, la carpeta por defecto), construido al primer uso."""
+    folder_id = folder_id or folder_config.default
+    cached = catalog_pool.get(folder_id)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+
+    # Un solo refresco a la vez por carpeta; el resto sirve el catálogo anterior si lo hay
+    lock = _catalog_refresh_lock(folder_id)
+    if not lock.acquire(blocking=not cached):
+        return cached[1]
+    try:
+        cached = catalog_pool.get(folder_id)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+        try:
+            files = list_folder_media(folder_id)
+        except CircuitOpenError:
+            stale = _stale_catalog(folder_id)
+            logger.warning(f"Drive degradado: sirviendo catálogo anterior de {folder_id} ({len(stale)} archivos)")
+            return stale
+        except Exception as e:
+            stale = _stale_catalog(folder_id)
+            logger.error(f"Error obteniendo archivos de Drive ({folder_id}): {e} (sirviendo {len(stale)} archivos en caché)")
+            return stale
+
+        logger.info(f"Cargados {len(files)} archivos desde Drive ({folder_id})")
+        files = MediaCatalog(_selection_view(files))
+        _save_catalog(folder_id, files)
+        catalog_pool.put(folder_id, files, _catalog_expiry())
+        return files
+    finally:
+        lock.release()
 
 def get_random_image_url():
     files = get_all_media_files_from_folder()
@@ -307,8 +1446,7 @@ def get_remote_file_size(url: str) -> Optional[int]:
             if cl:
                 return int(cl)
     except Exception:
-        if DEBUG:
-            print(f"[DEBUG] Error obteniendo Content-Length para {url}")
+        logger.debug("Error obteniendo Content-Length para %s", url)
     return None
 
 def select_random_file_with_limit(files, max_bytes: int, attempts: int = 10):
@@ -316,20 +1454,173 @@ def select_random_file_with_limit(files, max_bytes: int, attempts: int = 10):
     Si no se encuentra ninguno en `attempts`, devuelve None.
     """
     for _ in range(attempts):
-        f = random.choice(files)
-        # Si no es GIF, lo aceptamos de inmediato
-        if f.get('mimeType') != 'image/gif':
+        f = files.draw(max_bytes)
+        if f is None:
+            return None
+        # El catálogo ya descarta los GIFs grandes; queda comprobar los de tamaño desconocido
+        if _fits_limit(f, max_bytes):
             return f
 
-        url_check = f"https://drive.google.com/uc?export=download&id={f['id']}"
-        size = get_remote_file_size(url_check)
-        if size is None or size <= max_bytes:
-            return f
+    return None
+
+def _fits_limit(f: dict, max_bytes: int) -> bool:
+    # Si no es GIF, lo aceptamos de inmediato
+    if f.get('mimeType') != 'image/gif':
+        return True
+    # El listado de Drive ya trae el tamaño; HEAD solo como respaldo
+    if f.get('size'):
+        size = int(f['size'])
+    else:
+        size = get_remote_file_size(drive_download_url(f['id']))
+    return size is None or size <= max_bytes
+
+def select_random_files_with_limit(files, max_bytes: int, count: int, attempts: int = 10) -> list:
+    """Selecciona hasta `count` archivos distintos (por contenido) dentro del límite.
+
+    Con muchos candidatos sortea posiciones y descarta las repetidas; con
+    pocos recorre una permutación de todos. Se rinde tras `attempts` descartes
+    por archivo pedido.
+    """
+    if files.candidates(max_bytes) <= count * 4:
+        order = list(files.positions(max_bytes))
+        random.shuffle(order)
+        draws = iter(order)
+    else:
+        draws = (files.draw_position(max_bytes) for _ in itertools.count())
+    chosen, seen_positions, seen_keys = [], set(), set()
+    rejected = 0
+    for position in draws:
+        if position is None or len(chosen) >= count or rejected >= attempts * count:
+            break
+        if position in seen_positions:
+            rejected += 1
+            continue
+        seen_positions.add(position)
+        f = files[position]
+        key = media_key(f)
+        if key in seen_keys:
+            continue
+        if _fits_limit(f, max_bytes):
+            chosen.append(f)
+            seen_keys.add(key)
+        else:
+            rejected += 1
+    return chosen
+
+# ==========================
+# Transcoders (compresión de GIFs)
+# ==========================
+# Cada backend sabe comprimir un GIF hasta un tamaño objetivo. La
+# disponibilidad se detecta una sola vez al arrancar y el motor elige, por
+# archivo, el backend con mejor predicción de tiempo y tamaño de salida,
+# usando las estadísticas acumuladas de ejecuciones anteriores.
 
+# Peso de la última medición en las medias móviles de cada backend
+TRANSCODER_EWMA_ALPHA = 0.3
+
+class TranscoderStats:
+    """Estadísticas acumuladas de un backend: tiempos, tamaños y aciertos."""
+
+    def __init__(self):
+        # record() corre en los hilos de compresión; metrics()/summary() en el event loop
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.successes = 0
+        self.total_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Medias móviles usadas para predecir (None hasta la primera ejecución)
+        self.sec_per_mb = None
+        self.ratio = None
+
+    def record(self, seconds: float, in_bytes: int, out_bytes: Optional[int], target_bytes: int):
+        mb = max(in_bytes / (1024 * 1024), 0.001)
+        if out_bytes is not None:
+            ratio = out_bytes / in_bytes
+        else:
+            # No consiguió bajar del objetivo: el ratio alcanzable es peor que target/in
+            ratio = min(1.0, target_bytes / in_bytes * 1.25)
+        with self._lock:
+            self.runs += 1
+            self.total_seconds += seconds
+            if out_bytes is not None:
+                self.successes += 1
+                self.bytes_in += in_bytes
+                self.bytes_out += out_bytes
+            self.sec_per_mb = self._ewma(self.sec_per_mb, seconds / mb)
+            self.ratio = self._ewma(self.ratio, ratio)
+
+    @staticmethod
+    def _ewma(current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return TRANSCODER_EWMA_ALPHA * value + (1 - TRANSCODER_EWMA_ALPHA) * current
+
+    def summary(self) -> str:
+        with self._lock:
+            if not self.runs:
+                return "sin ejecuciones"
+            avg = self.total_seconds / self.runs
+            saved = self.bytes_in - self.bytes_out
+            return (
+                f"{self.successes}/{self.runs} ok, {avg:.1f}s medio, "
+                f"{self.sec_per_mb:.2f}s/MB, ratio {self.ratio:.2f}, "
+                f"{saved/1024/1024:.1f} MB ahorrados"
+            )
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "successes": self.successes,
+                "avg_seconds": round(self.total_seconds / self.runs, 2) if self.runs else None,
+                "sec_per_mb": round(self.sec_per_mb, 3) if self.sec_per_mb is not None else None,
+                "ratio": round(self.ratio, 3) if self.ratio is not None else None,
+                "saved_mb": round((self.bytes_in - self.bytes_out) / 1024 / 1024, 1),
+            }
+
+class TranscoderBackend:
+    """Interfaz base de un backend de compresión de GIFs."""
+
+    name = "base"
+    # Predicciones iniciales antes de tener mediciones propias
+    default_sec_per_mb = 1.0
+    default_ratio = 0.5
+
+    def __init__(self):
+        self.stats = TranscoderStats()
+
+    def detect(self) -> bool:
+        """Comprueba si el backend puede usarse en este sistema."""
+        return False
+
+    def predict(self, size_bytes: int) -> tuple:
+        """Devuelve (segundos estimados, bytes de salida estimados)."""
+        sec_per_mb = self.stats.sec_per_mb if self.stats.sec_per_mb is not None else self.default_sec_per_mb
+        ratio = self.stats.ratio if self.stats.ratio is not None else self.default_ratio
+        return sec_per_mb * size_bytes / (1024 * 1024), int(size_bytes * ratio)
+
+    def transcode(self, input_path: str, target_bytes: int) -> Optional[str]:
+        """Comprime `input_path`; devuelve la ruta de salida si queda <= target_bytes."""
+        raise NotImplementedError
+
+def _finish_transcode_output(out_path: str, target_bytes: int) -> Optional[str]:
+    """Devuelve out_path si existe y cumple el objetivo; si no, lo elimina."""
+    if os.path.exists(out_path):
+        try:
+            if os.path.getsize(out_path) <= target_bytes:
+                return out_path
+        except Exception:
+            pass
+    scratch.release(out_path)
     return None
 
+# Rutas de binarios resueltas una sola vez al arrancar
+_FFMPEG_BIN = shutil.which("ffmpeg")
+_GIFSICLE_BIN = shutil.which("gifsicle")
+
 def ffmpeg_available() -> bool:
-    return shutil.which("ffmpeg") is not None
+    return _FFMPEG_BIN is not None
 
 def compress_gif_with_ffmpeg(input_path: str, target_bytes: int, attempts: int = 6) -> Optional[str]:
     """Attempt to compress the GIF using ffmpeg and palette optimization.
@@ -339,11 +1630,8 @@ def compress_gif_with_ffmpeg(input_path: str, target_bytes: int, attempts: int =
         logger.debug("ffmpeg no está disponible en el sistema")
         return None
 
-    base = os.path.splitext(input_path)[0]
-    palette = f"{base}_palette.png"
-    out_path = f"{base}_compressed.gif"
-    register_temp_file(palette)
-    register_temp_file(out_path)
+    palette = scratch.new_path("_palette.png")
+    out_path = scratch.new_path("_compressed.gif", expected_bytes=target_bytes)
 
     scale_factor = 1.0
     fps = 20
@@ -353,51 +1641,1778 @@ def compress_gif_with_ffmpeg(input_path: str, target_bytes: int, attempts: int =
         scale = f"iw*{scale_factor}:-1"
         try:
             cmd_palette = [
-                "ffmpeg", "-y", "-i", input_path,
+                _FFMPEG_BIN, "-y", "-i", input_path,
                 "-vf", f"fps={fps},scale={scale}:flags=lanczos,palettegen", palette
             ]
             subprocess.run(cmd_palette, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
 
             cmd_use = [
-                "ffmpeg", "-y", "-i", input_path, "-i", palette,
+                _FFMPEG_BIN, "-y", "-i", input_path, "-i", palette,
                 "-lavfi", f"fps={fps},scale={scale}:flags=lanczos [x]; [x][1:v] paletteuse",
                 out_path
             ]
             subprocess.run(cmd_use, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
 
             out_size = os.path.getsize(out_path)
-            logger.debug(f"Intento compresión {i+1}: size={out_size} bytes, target={target_bytes}")
+            logger.debug("Intento compresión %d: size=%d bytes, target=%d", i + 1, out_size, target_bytes)
             if out_size <= target_bytes:
                 # cleanup palette
-                cleanup_temp_file(palette)
+                scratch.release(palette)
                 return out_path
 
         except subprocess.TimeoutExpired:
             logger.warning(f"Timeout en compresión ffmpeg (intento {i+1})")
         except Exception as e:
-            logger.debug(f"Error en compresión: {e}")
+            logger.debug("Error en compresión: %s", e)
 
         # make compression stronger
         scale_factor *= 0.75
         fps = max(8, int(fps * 0.85))
 
     # final cleanup
-    cleanup_temp_file(palette)
+    scratch.release(palette)
 
     # if out_path exists but not small enough, remove it
-    if os.path.exists(out_path):
-        try:
-            if os.path.getsize(out_path) <= target_bytes:
-                return out_path
-        except Exception:
-            pass
-        cleanup_temp_file(out_path)
+    return _finish_transcode_output(out_path, target_bytes)
 
-    return None
+class FfmpegTranscoder(TranscoderBackend):
+    """Paleta optimizada + reducción progresiva de escala y fps con ffmpeg."""
 
-# ==========================
-# Eventos y comandos
-# ==========================
+    name = "ffmpeg"
+    default_sec_per_mb = 1.5
+    default_ratio = 0.35
+
+    def detect(self) -> bool:
+        return ffmpeg_available()
+
+    def transcode(self, input_path: str, target_bytes: int) -> Optional[str]:
+        return compress_gif_with_ffmpeg(input_path, target_bytes)
+
+class GifsicleTranscoder(TranscoderBackend):
+    """Optimización con pérdida (--lossy) de gifsicle, sin decodificar a vídeo."""
+
+    name = "gifsicle"
+    default_sec_per_mb = 0.6
+    default_ratio = 0.6
+
+    def detect(self) -> bool:
+        return _GIFSICLE_BIN is not None
+
+    def transcode(self, input_path: str, target_bytes: int, attempts: int = 5) -> Optional[str]:
+        out_path = scratch.new_path("_gifsicle.gif", expected_bytes=target_bytes)
+
+        lossy = 40
+        colors = 256
+        scale = 1.0
+
+        for i in range(attempts):
+            try:
+                cmd = [
+                    _GIFSICLE_BIN, "-O3", f"--lossy={lossy}", f"--colors={colors}",
+                    "--scale", f"{scale:.3f}", input_path, "-o", out_path
+                ]
+                subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+
+                out_size = os.path.getsize(out_path)
+                logger.debug("Intento gifsicle %d: size=%d bytes, target=%d", i + 1, out_size, target_bytes)
+                if out_size <= target_bytes:
+                    return out_path
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Timeout en compresión gifsicle (intento {i+1})")
+            except Exception as e:
+                logger.debug("Error en compresión gifsicle: %s", e)
+
+            lossy = min(200, lossy + 40)
+            colors = max(64, colors // 2)
+            scale *= 0.8
+
+        return _finish_transcode_output(out_path, target_bytes)
+
+class PillowTranscoder(TranscoderBackend):
+    """Re-cuantiza la paleta, reescala y descarta frames usando Pillow (sin binarios externos)."""
+
+    name = "pillow"
+    default_sec_per_mb = 3.0
+    default_ratio = 0.5
+
+    def detect(self) -> bool:
+        return Image is not None
+
+    @staticmethod
+    def _frames(im, scale: float, step: int, colors: int):
+        """Frames ya reescalados y cuantizados, uno a uno, con su duración en info."""
+        pending = None
+        for idx, frame in enumerate(ImageSequence.Iterator(im)):
+            duration = frame.info.get("duration", 100)
+            if idx % step:
+                # Frame descartado: su duración pasa al anterior para mantener el ritmo
+                if pending is not None:
+                    pending.info["duration"] += duration
+                continue
+            if pending is not None:
+                yield pending
+            f = frame.convert("RGB")
+            if scale < 1.0:
+                size = (max(1, int(f.width * scale)), max(1, int(f.height * scale)))
+                f = f.resize(size, Image.LANCZOS)
+            pending = f.quantize(colors=colors)
+            pending.info["duration"] = duration
+        if pending is not None:
+            yield pending
+
+    @classmethod
+    def _reencode(cls, input_path: str, out_path: str, scale: float, step: int, colors: int) -> bool:
+        """Reescribe el GIF; False si el intento superaría PILLOW_MAX_MEGAPIXELS."""
+        with Image.open(input_path) as im:
+            # Pillow retiene todos los frames hasta escribir el archivo: se acota antes de empezar
+            kept = -(-getattr(im, "n_frames", 1) // step)
+            megapixels = kept * im.width * im.height * min(scale, 1.0) ** 2 / 1e6
+            if megapixels > PILLOW_MAX_MEGAPIXELS:
+                logger.debug("Intento Pillow omitido: %.0f Mpx > %.0f", megapixels, PILLOW_MAX_MEGAPIXELS)
+                return False
+            frames = cls._frames(im, scale, step, colors)
+            first = next(frames)
+            first.save(
+                out_path, save_all=True, append_images=frames,
+                loop=im.info.get("loop", 0), optimize=True, disposal=2
+            )
+        return True
+
+    def transcode(self, input_path: str, target_bytes: int, attempts: int = 5) -> Optional[str]:
+        out_path = scratch.new_path("_pillow.gif", expected_bytes=target_bytes)
+
+        scale = 1.0
+        step = 1
+        colors = 128
+
+        for i in range(attempts):
+            try:
+                if self._reencode(input_path, out_path, scale, step, colors):
+                    out_size = os.path.getsize(out_path)
+                    logger.debug("Intento Pillow %d: size=%d bytes, target=%d", i + 1, out_size, target_bytes)
+                    if out_size <= target_bytes:
+                        return out_path
+            except Exception as e:
+                logger.debug("Error en compresión Pillow: %s", e)
+
+            scale *= 0.75
+            step = min(4, step + 1)
+            colors = max(32, colors // 2)
+
+        return _finish_transcode_output(out_path, target_bytes)
+
+def detect_transcoders() -> list:
+    """Detecta una vez qué backends están disponibles."""
+    available = [backend for backend in (FfmpegTranscoder(), GifsicleTranscoder(), PillowTranscoder()) if backend.detect()]
+    if available:
+        logger.info(f"Transcoders disponibles: {', '.join(b.name for b in available)}")
+    else:
+        logger.warning("Ningún transcoder disponible: los GIFs grandes no podrán comprimirse")
+    return available
+
+TRANSCODERS = detect_transcoders()
+
+def transcoders_available() -> bool:
+    return bool(TRANSCODERS)
+
+def choose_transcoders(size_bytes: int, target_bytes: int) -> list:
+    """Ordena los backends para un archivo: primero los que se espera que lleguen
+    al objetivo, y entre ellos los más rápidos."""
+    def score(backend):
+        seconds, out_bytes = backend.predict(size_bytes)
+        return (out_bytes > target_bytes, seconds)
+    return sorted(TRANSCODERS, key=score)
+
+def compress_gif(input_path: str, target_bytes: int) -> Optional[str]:
+    """Comprime un GIF con el mejor backend disponible, probando los demás si falla.
+    Returns path to compressed file if successful and <= target_bytes, else None.
+    """
+    try:
+        in_bytes = os.path.getsize(input_path)
+    except OSError as e:
+        logger.error(f"No se pudo leer {input_path}: {e}")
+        return None
+
+    for backend in choose_transcoders(in_bytes, target_bytes):
+        start = time.monotonic()
+        out_path = backend.transcode(input_path, target_bytes)
+        elapsed = time.monotonic() - start
+        out_bytes = os.path.getsize(out_path) if out_path else None
+        backend.stats.record(elapsed, in_bytes, out_bytes, target_bytes)
+        logger.info(f"Transcoder {backend.name}: {'ok' if out_path else 'fallido'} en {elapsed:.1f}s ({backend.stats.summary()})")
+        if out_path:
+            return out_path
+
+    return None
+
+def transcoder_metrics() -> dict:
+    """Estadísticas acumuladas por backend, para comparar cuál rinde mejor con nuestros GIFs."""
+    return {b.name: b.stats.metrics() for b in TRANSCODERS}
+
+# ==========================
+# Caché local de medios
+# ==========================
+
+# Un .part sin dueño vivo (o de una versión sin pid en el nombre) se borra pasado este tiempo
+MEDIA_CACHE_PART_STALE_SECONDS = 3600
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # existe, pero es de otro usuario
+    return True
+
+class MediaCache:
+    """Caché en disco de artefactos derivados (variantes, GIFs comprimidos...).
+
+    Las entradas se guardan por clave en `directory` y se expulsan por LRU
+    (fecha de último uso) cuando el total supera `max_bytes`. Varios procesos
+    (el bot y `precompute`) pueden compartir el directorio: cada uno adopta
+    las entradas que escriben los demás al buscarlas o al cambiar el directorio.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # clave -> tamaño en bytes
+        self._total = 0
+        self._lock = threading.Lock()
+        self.generation = 0  # cambia cada vez que entra o sale una clave
+        self._dir_mtime = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _scan(self) -> list:
+        """(mtime, nombre, tamaño) de las entradas en disco; barre los .part abandonados."""
+        found = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith(".part"):
+                # Escritura en curso de este u otro proceso, o a medias de uno que murió
+                pid = entry.name[:-len(".part")].rpartition(".")[2]
+                orphan = pid.isdigit() and not _pid_alive(int(pid))
+                if orphan or now - st.st_mtime > MEDIA_CACHE_PART_STALE_SECONDS:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                continue
+            if entry.is_file():
+                found.append((st.st_mtime, entry.name, st.st_size))
+        return found
+
+    def _load(self):
+        self._dir_mtime = os.stat(self.directory).st_mtime_ns
+        found = self._scan()
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total += size
+        if found:
+            logger.info(f"Caché de medios: {len(found)} entradas, {self._total/1024/1024:.1f} MB en {self.directory}")
+
+    def refresh(self):
+        """Sincroniza con lo que otros procesos añadieron o expulsaron (un stat si nada cambió)."""
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._dir_mtime:
+            return
+        found = self._scan()
+        on_disk = {name: size for _, name, size in found}
+        with self._lock:
+            self._dir_mtime = mtime
+            changed = False
+            for key in [k for k in self._entries if k not in on_disk]:
+                self._total -= self._entries.pop(key)
+                changed = True
+            for _, name, size in sorted(found):
+                if name not in self._entries:
+                    self._entries[name] = size
+                    self._total += size
+                    changed = True
+            if changed:
+                self.generation += 1
+                self._evict()
+
+    def _adopt(self, key: str) -> bool:
+        """Registra `key` si otro proceso la dejó en disco. Con el lock tomado."""
+        path = self.path_for(key)
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return False
+        if not os.path.isfile(path):
+            return False
+        self._entries[key] = size
+        self._total += size
+        self.generation += 1
+        self._evict()
+        return key in self._entries
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def staging_path(self, key: str) -> str:
+        """Ruta para escribir una entrada antes de `put`, marcada con el pid del proceso.
+
+        Otros procesos no la adoptan como entrada y solo la barren si su dueño murió.
+        """
+        return f"{self.path_for(key)}.{os.getpid()}.part"
+
+    def contains(self, key: str, check_disk: bool = True) -> bool:
+        """Si `key` está en la caché. Sin `check_disk` no se mira el disco en un fallo
+        (para recorridos masivos justo después de `refresh`)."""
+        with self._lock:
+            return key in self._entries or (check_disk and self._adopt(key))
+
+    def get(self, key: str) -> Optional[str]:
+        """Devuelve la ruta cacheada para `key` o None, marcándola como usada."""
+        with self._lock:
+            if key not in self._entries and not self._adopt(key):
+                return None
+            path = self.path_for(key)
+            if not os.path.exists(path):
+                self._total -= self._entries.pop(key)
+                self.generation += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put(self, key: str, src_path: str) -> str:
+        """Mueve `src_path` a la caché bajo `key` y devuelve la ruta final."""
+        dest = self.path_for(key)
+        moved = False
+        if not os.path.islink(src_path):
+            try:
+                os.replace(src_path, dest)
+                moved = True
+            except OSError:
+                pass  # Scratch en otro sistema de archivos (tmpfs)
+        if not moved:
+            # Copiar (de memfd, el contenido y no el enlace) a staging y renombrar:
+            # otro proceso nunca debe adoptar una entrada a medio escribir
+            staging = self.staging_path(key)
+            shutil.copyfile(src_path, staging)
+            os.replace(staging, dest)
+        size = os.path.getsize(dest)
+        with self._lock:
+            if key in self._entries:
+                self._total -= self._entries.pop(key)
+            else:
+                self.generation += 1
+            self._entries[key] = size
+            self._total += size
+            self._evict()
+        return dest
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            self.generation += 1
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+            logger.debug("Caché: expulsado %s (%d bytes)", key, size)
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MB * 1024 * 1024)
+
+# ==========================
+# Descargas
+# ==========================
+# Las descargas se reanudan con peticiones Range tras un corte, reintentan
+# con backoff exponencial, ajustan el tamaño de lectura al throughput
+# observado y se verifican contra el md5Checksum que devuelve Drive.
+
+DOWNLOAD_MIN_CHUNK = 64 * 1024
+DOWNLOAD_MAX_CHUNK = 4 * 1024 * 1024
+# Cada lectura debería traer aproximadamente este tiempo de datos
+DOWNLOAD_CHUNK_TARGET_SECONDS = 0.25
+
+class DownloadError(Exception):
+    """Error de descarga. `retriable` indica si tiene sentido reintentar."""
+
+    def __init__(self, message: str, retriable: bool = True):
+        super().__init__(message)
+        self.retriable = retriable
+
+class DownloadTooLarge(DownloadError):
+    """El archivo supera el límite: la descarga se corta sin bajar el resto."""
+
+    def __init__(self, size: int, limit: int):
+        super().__init__(f"supera el límite ({size/1024/1024:.1f} MB > {limit/1024/1024:.0f} MB)", retriable=False)
+        self.size = size
+        self.limit = limit
+
+def drive_download_url(file_id: str) -> str:
+    return f"https://drive.google.com/uc?export=download&id={file_id}"
+
+def _next_chunk_size(throughput: float) -> int:
+    """Tamaño de lectura para ~DOWNLOAD_CHUNK_TARGET_SECONDS de datos, en potencia de 2."""
+    wanted = int(throughput * DOWNLOAD_CHUNK_TARGET_SECONDS)
+    size = DOWNLOAD_MIN_CHUNK
+    while size < wanted and size < DOWNLOAD_MAX_CHUNK:
+        size *= 2
+    return size
+
+def _response_total_bytes(r) -> Optional[int]:
+    """Tamaño total anunciado por el servidor (Content-Range en 206, Content-Length en 200)."""
+    if r.status_code == 206:
+        total = r.headers.get("Content-Range", "").rpartition("/")[2]
+    else:
+        total = r.headers.get("Content-Length", "")
+    return int(total) if total.isdigit() else None
+
+def download_file(url: str, path: str, expected_bytes: int = 0,
+                  md5_checksum: Optional[str] = None, name: str = "", max_bytes: int = 0) -> float:
+    """Descarga `url` en `path` reanudando tras cortes. Devuelve el throughput en bytes/s.
+
+    Lanza DownloadError (o la última excepción de requests) si se agotan los reintentos.
+    """
+    with open(path, "wb") as out:
+        def restart():
+            out.seek(0)
+            out.truncate()
+        return stream_download(url, out.write, restart, expected_bytes, md5_checksum, name, max_bytes)
+
+def stream_download(url: str, write, restart=None, expected_bytes: int = 0,
+                    md5_checksum: Optional[str] = None, name: str = "", max_bytes: int = 0) -> float:
+    """Descarga `url` entregando cada bloque a `write` a medida que llega.
+
+    Tras un corte se reanuda con Range; si el servidor lo ignora se llama a
+    `restart()` para empezar de cero (sin `restart`, falla sin reintentar).
+    Con `max_bytes` se corta en cuanto el tamaño anunciado o lo recibido lo
+    supera (DownloadTooLarge). Devuelve el throughput en bytes/s.
+    """
+    written = 0
+    hasher = hashlib.md5()
+    chunk_size = DOWNLOAD_MIN_CHUNK
+    started = time.monotonic()
+    retries = 0
+    last_error = None
+
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        if attempt:
+            retries += 1
+            delay = min(30.0, DOWNLOAD_BACKOFF_SECONDS * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            logger.warning(f"Descarga {name or url}: reintento {attempt} en {delay:.1f}s desde byte {written} ({last_error})")
+            time.sleep(delay)
+
+        headers = {"Range": f"bytes={written}-"} if written else {}
+        try:
+            with requests.get(url, stream=True, headers=headers,
+                              timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as r:
+                if r.status_code == 416 and expected_bytes and written == expected_bytes:
+                    break  # ya estaba completo
+                if r.status_code == 200 and written:
+                    # El servidor ignoró el Range: empezar de cero
+                    if restart is None:
+                        raise DownloadError("el servidor no admite Range", retriable=False)
+                    logger.debug("Descarga %s: sin soporte de Range, reiniciando", name or url)
+                    restart()
+                    written = 0
+                    hasher = hashlib.md5()
+                elif r.status_code not in (200, 206):
+                    retriable = r.status_code == 429 or r.status_code >= 500
+                    raise DownloadError(f"HTTP {r.status_code}", retriable=retriable)
+
+                total = _response_total_bytes(r)
+                if max_bytes and total and total > max_bytes:
+                    raise DownloadTooLarge(total, max_bytes)
+
+                while True:
+                    t0 = time.monotonic()
+                    chunk = r.raw.read(chunk_size, decode_content=True)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if max_bytes and written > max_bytes:
+                        raise DownloadTooLarge(written, max_bytes)
+                    write(chunk)
+                    hasher.update(chunk)
+                    elapsed = time.monotonic() - t0
+                    if elapsed > 0:
+                        chunk_size = _next_chunk_size(len(chunk) / elapsed)
+
+            if expected_bytes and written < expected_bytes:
+                raise DownloadError(f"incompleta ({written}/{expected_bytes} bytes)")
+            break
+        except DownloadError as e:
+            last_error = e
+            if not e.retriable:
+                raise
+        except (requests.ConnectionError, requests.Timeout, urllib3.exceptions.HTTPError) as e:
+            last_error = e
+    else:
+        if isinstance(last_error, requests.Timeout):
+            raise last_error
+        raise DownloadError(f"reintentos agotados: {last_error}")
+
+    if md5_checksum and hasher.hexdigest() != md5_checksum:
+        raise DownloadError(f"md5 no coincide ({hasher.hexdigest()} != {md5_checksum})", retriable=False)
+
+    elapsed = max(time.monotonic() - started, 0.001)
+    throughput = written / elapsed
+    logger.info(
+        f"Descarga {name or url}: {written/1024/1024:.2f} MB en {elapsed:.1f}s "
+        f"({throughput/1024/1024:.2f} MB/s, {retries} reintentos)"
+    )
+    return throughput
+
+def download_to_temp(url: str, suffix: str, expected_bytes: int = 0,
+                     md5_checksum: Optional[str] = None, name: str = "", max_bytes: int = 0) -> str:
+    """Descarga `url` a un archivo del scratch y devuelve la ruta.
+
+    Los errores se propagan (DownloadError con su `retriable`, timeouts...) para
+    que quien llama decida si cuentan como caída del servicio o avisar al usuario.
+    """
+    path = scratch.new_path(suffix, expected_bytes=expected_bytes)
+    try:
+        download_file(url, path, expected_bytes, md5_checksum, name, max_bytes)
+        return path
+    except BaseException:
+        scratch.release(path)
+        raise
+
+def _record_download_error(error: Exception):
+    """Solo los errores transitorios (5xx, conexión, reintentos agotados) cuentan como caída de Drive."""
+    if isinstance(error, DownloadError) and not error.retriable:
+        # Drive respondió (404, 403, md5 distinto...): el servicio está sano aunque la descarga falle
+        drive_breaker.record_success()
+    else:
+        drive_breaker.record_failure()
+
+def download_drive_file(file: dict, suffix: Optional[str] = None, max_bytes: int = 0) -> str:
+    """Descarga un archivo del catálogo de Drive al scratch, verificando su md5."""
+    return download_to_temp(
+        drive_download_url(file["id"]),
+        suffix or os.path.splitext(file["name"])[1] or ".img",
+        expected_bytes=int(file.get("size") or 0),
+        md5_checksum=file.get("md5Checksum"),
+        name=file["name"],
+        max_bytes=max_bytes,
+    )
+
+class KeyedLocks:
+    """Un lock por clave, para que el trabajo sobre un mismo contenido no se duplique."""
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+        self._guard = threading.Lock()
+
+    def get(self, key: str) -> threading.Lock:
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._locks[key] = lock
+            return lock
+
+# Descargas y artefactos en curso, por contenido (copias idénticas comparten lock)
+media_locks = KeyedLocks()
+
+def original_cache_key(file: dict) -> str:
+    return f"orig_{media_key(file)}{os.path.splitext(file['name'])[1].lower()}"
+
+def fetch_original(file: dict, suffix: Optional[str] = None, cache: bool = True) -> tuple:
+    """Obtiene el original de un archivo: de la caché local o descargándolo de Drive.
+
+    Devuelve (ruta, es_temporal); las rutas temporales hay que liberarlas del
+    scratch. Con `cache` los originales de hasta MAX_GIF_MB se guardan en la
+    caché para poder servirlos aunque Drive esté caído.
+    """
+    key = original_cache_key(file)
+    cached = media_cache.get(key)
+    if cached:
+        return cached, False
+
+    with media_locks.get(key):
+        # Otra petición pudo descargar el mismo contenido mientras esperábamos
+        cached = media_cache.get(key)
+        if cached:
+            return cached, False
+        return _download_original(file, key, suffix, cache)
+
+def _download_original(file: dict, key: str, suffix: Optional[str], cache: bool) -> tuple:
+    if not drive_breaker.allow():
+        raise MediaUnavailable("Google Drive no está disponible ahora mismo. Intenta de nuevo en unos minutos.")
+    try:
+        path = download_drive_file(file, suffix, max_bytes=MAX_GIF_SIZE_BYTES)
+    except requests.Timeout:
+        drive_breaker.record_failure()
+        raise
+    except DownloadTooLarge as e:
+        drive_breaker.record_success()
+        logger.info(f"Descarga {file['name']} cortada: {e}")
+        raise MediaUnavailable(f"Archivo omitido — demasiado grande ({e.size/1024/1024:.1f} MB). Límite: {MAX_GIF_MB} MB.")
+    except (DownloadError, requests.RequestException) as e:
+        _record_download_error(e)
+        logger.error(f"Descarga fallida {file['name']}: {e}")
+        return None, False
+    except BaseException:
+        # Fallo local (p. ej. cuota del scratch): Drive no llegó a probarse
+        drive_breaker.release_probe()
+        raise
+    drive_breaker.record_success()
+
+    if cache and os.path.getsize(path) <= MAX_GIF_SIZE_BYTES:
+        cached = media_cache.put(key, path)
+        scratch.release(path)
+        return cached, False
+    return path, True
+
+# --------------------------
+# Descarga y compresión en paralelo
+# --------------------------
+# Para un GIF que ya se sabe más grande que el límite de subida, los bytes se
+# pasan a ffmpeg por stdin según llegan: descarga y compresión se solapan y el
+# original no pasa por el scratch (se escribe directamente en la caché, que lo
+# necesita igualmente para reintentos más agresivos y el modo offline).
+
+# Ratio aproximado de ffmpeg a escala completa; con él se estima la escala del único intento
+STREAM_BASELINE_RATIO = 0.6
+STREAM_FPS = 20
+
+def _stream_scale(size_bytes: int, target_bytes: int) -> float:
+    needed = target_bytes / max(size_bytes, 1) * 0.9
+    if needed >= STREAM_BASELINE_RATIO:
+        return 1.0
+    # El tamaño crece con el área: escalar por la raíz de la reducción que falta
+    return max(0.2, (needed / STREAM_BASELINE_RATIO) ** 0.5)
+
+def stream_transcode_gif(file: dict, target_bytes: int) -> Optional[str]:
+    """Descarga `file` y lo comprime con ffmpeg a la vez, en un solo intento.
+
+    Devuelve la ruta (scratch) del GIF comprimido si cumple `target_bytes`, o
+    None para seguir por el camino normal (el original ya estará en la caché).
+    Bloqueante: llamar desde un hilo.
+    """
+    key = original_cache_key(file)
+    size = int(file.get("size") or 0)
+    scale = _stream_scale(size, target_bytes)
+
+    with media_locks.get(key):
+        if media_cache.contains(key):
+            return None
+        if not drive_breaker.allow():
+            raise MediaUnavailable("Google Drive no está disponible ahora mismo. Intenta de nuevo en unos minutos.")
+
+        try:
+            return _stream_into_ffmpeg(file, key, size, scale, target_bytes)
+        except BaseException:
+            # Un fallo local (scratch, ffmpeg, disco) no dice nada de Drive: liberar la prueba
+            drive_breaker.release_probe()
+            raise
+
+def _stream_into_ffmpeg(file: dict, key: str, size: int, scale: float, target_bytes: int) -> Optional[str]:
+    """Cuerpo de stream_transcode_gif, con la prueba del breaker ya concedida."""
+    out_path = scratch.new_path("_stream.gif", expected_bytes=target_bytes)
+    part = media_cache.staging_path(key)
+    # Paleta por fotograma: con una paleta global palettegen solo emite al final
+    # del stream y split retendría en memoria todos los fotogramas decodificados
+    cmd = [
+        _FFMPEG_BIN, "-y", "-f", "gif", "-i", "pipe:0",
+        "-filter_complex",
+        f"fps={STREAM_FPS},scale=iw*{scale:.3f}:-1:flags=lanczos,split[a][b];"
+        "[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1",
+        out_path,
+    ]
+    started = time.monotonic()
+    deadline = started + STREAM_TRANSCODE_TIMEOUT
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except BaseException:
+        scratch.release(out_path)
+        raise
+    expired = threading.Event()
+
+    def expire():
+        # Matar ffmpeg también desbloquea un write a stdin atascado (BrokenPipe)
+        expired.set()
+        proc.kill()
+
+    # Si ffmpeg va más lento que la red, stdin se llena y cada write espera a
+    # ffmpeg: el plazo cuenta desde el arranque, no desde el fin de la descarga
+    watchdog = threading.Timer(STREAM_TRANSCODE_TIMEOUT, expire)
+    watchdog.daemon = True
+    watchdog.start()
+    feeding = True
+    result = None
+    try:
+        with open(part, "wb") as original:
+            def write(chunk):
+                nonlocal feeding
+                original.write(chunk)
+                if feeding and time.monotonic() >= deadline:
+                    expire()
+                if feeding and not expired.is_set():
+                    try:
+                        proc.stdin.write(chunk)
+                    except OSError:
+                        # ffmpeg terminó (o se mató por el plazo); el original sigue llegando a la caché
+                        feeding = False
+
+            try:
+                stream_download(drive_download_url(file["id"]), write, None, size,
+                                file.get("md5Checksum"), file["name"], MAX_GIF_SIZE_BYTES)
+            except requests.Timeout:
+                drive_breaker.record_failure()
+                raise
+            except DownloadTooLarge as e:
+                drive_breaker.record_success()
+                raise MediaUnavailable(f"GIF omitido — demasiado grande ({e.size/1024/1024:.1f} MB). Límite: {MAX_GIF_MB} MB.")
+            except (DownloadError, requests.RequestException) as e:
+                _record_download_error(e)
+                logger.warning(f"Descarga en streaming de {file['name']} fallida: {e}")
+                return None
+        drive_breaker.record_success()
+        media_cache.put(key, part)
+
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+        if proc.returncode != 0 and expired.is_set():
+            raise subprocess.TimeoutExpired(cmd, STREAM_TRANSCODE_TIMEOUT)
+        if proc.returncode == 0:
+            result = _finish_transcode_output(out_path, target_bytes)
+        logger.info(
+            f"Streaming {file['name']}: {size/1024/1024:.1f} MB -> "
+            f"{(os.path.getsize(result) if result else 0)/1024/1024:.1f} MB a escala {scale:.2f} "
+            f"en {time.monotonic() - started:.1f}s ({'ok' if result else 'sin cumplir el objetivo'})"
+        )
+        return result
+    except subprocess.TimeoutExpired:
+        logger.warning(
+            f"Timeout en compresión en streaming de {file['name']} "
+            f"({STREAM_TRANSCODE_TIMEOUT:g}s desde el arranque)"
+        )
+        return None
+    finally:
+        watchdog.cancel()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if proc.stdin and not proc.stdin.closed:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+        if result is None:
+            scratch.release(out_path)
+        if os.path.exists(part):
+            os.remove(part)
+
+def is_servable_offline(file: dict, check_disk: bool = True) -> bool:
+    """Si el archivo puede enviarse sin contactar con Drive."""
+    if media_cache.contains(original_cache_key(file), check_disk):
+        return True
+    return file.get("mimeType") != "image/gif" and media_cache.contains(image_variant_key(file), check_disk)
+
+# Índice de lo servible sin Drive por catálogo: (generación de la caché, instante, vista)
+_offline_views = weakref.WeakKeyDictionary()
+OFFLINE_INDEX_REFRESH_SECONDS = 30
+
+def offline_view(files: MediaCatalog) -> CatalogView:
+    """Archivos del catálogo que están en la caché local, para sortear con Drive degradado.
+
+    Recorre el catálogo entero, así que se memoiza: solo se recalcula si la
+    caché cambió, y como mucho cada OFFLINE_INDEX_REFRESH_SECONDS. Bloqueante.
+    """
+    memo = _offline_views.get(files)
+    now = time.monotonic()
+    media_cache.refresh()  # lo que haya dejado precompute u otro proceso
+    generation = media_cache.generation
+    if memo and (memo[0] == generation or now - memo[1] < OFFLINE_INDEX_REFRESH_SECONDS):
+        return memo[2]
+    view = CatalogView(files, array("I", (i for i in range(len(files)) if is_servable_offline(files[i], check_disk=False))))
+    _offline_views[files] = (generation, now, view)
+    logger.debug("Índice offline: %d de %d archivos en %.2fs", len(view), len(files), time.monotonic() - now)
+    return view
+
+# ==========================
+# Variantes de imagen
+# ==========================
+# Las fotos originales suelen pesar varios MB; el proxy de Discord tiene que
+# seguir las redirecciones de Drive y bajar el original completo. Para
+# imágenes grandes se genera una variante redimensionada y recomprimida que
+# se cachea y se sube como adjunto en lugar de incrustar la URL de Drive.
+
+def _image_needs_variant(file: dict) -> bool:
+    size = int(file.get("size") or 0)
+    meta = file.get("imageMediaMetadata") or {}
+    max_side = max(int(meta.get("width") or 0), int(meta.get("height") or 0))
+    return size > IMAGE_VARIANT_THRESHOLD_BYTES or max_side > IMAGE_VARIANT_MAX_DIM
+
+def image_variant_key(file: dict) -> str:
+    return f"{media_key(file)}_{IMAGE_VARIANT_MAX_DIM}_q{IMAGE_VARIANT_QUALITY}.{IMAGE_VARIANT_FORMAT}"
+
+def build_image_variant(input_path: str, out_path: str):
+    """Redimensiona y recomprime una imagen al formato de variante configurado."""
+    with Image.open(input_path) as im:
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((IMAGE_VARIANT_MAX_DIM, IMAGE_VARIANT_MAX_DIM), Image.LANCZOS)
+        if IMAGE_VARIANT_FORMAT == "webp":
+            if im.mode not in ("RGB", "RGBA"):
+                im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+            im.save(out_path, "WEBP", quality=IMAGE_VARIANT_QUALITY, method=4)
+        else:
+            im.convert("RGB").save(out_path, "JPEG", quality=IMAGE_VARIANT_QUALITY, optimize=True, progressive=True)
+
+def get_image_variant(file: dict) -> Optional[str]:
+    """Devuelve la ruta de la variante cacheada de una imagen grande,
+    generándola si hace falta. None si no aplica o si falla."""
+    if Image is None or not _image_needs_variant(file):
+        return None
+
+    key = image_variant_key(file)
+    cached = media_cache.get(key)
+    if cached:
+        return cached
+
+    with media_locks.get(key):
+        return media_cache.get(key) or _build_and_cache_variant(file, key)
+
+def _build_and_cache_variant(file: dict, key: str) -> Optional[str]:
+    src = None
+    src_is_temp = False
+    out_path = None
+    try:
+        src, src_is_temp = fetch_original(file, cache=False)
+        if not src:
+            return None
+        out_path = scratch.new_path(f"_variant.{IMAGE_VARIANT_FORMAT}")
+        build_image_variant(src, out_path)
+
+        orig_size = os.path.getsize(src)
+        variant_size = os.path.getsize(out_path)
+        if variant_size >= orig_size:
+            logger.debug("Variante de %s no reduce tamaño (%d >= %d)", file['name'], variant_size, orig_size)
+            return None
+        logger.info(f"Variante de {file['name']}: {orig_size/1024:.0f} KB -> {variant_size/1024:.0f} KB")
+        path = media_cache.put(key, out_path)
+        scratch.release(out_path)
+        return path
+    except MediaUnavailable:
+        return None
+    except Exception as e:
+        logger.warning(f"No se pudo generar variante de {file.get('name')}: {e}")
+        return None
+    finally:
+        if src and src_is_temp:
+            scratch.release(src)
+        if out_path:
+            scratch.release(out_path)
+
+# --------------------------
+# Vistas previas
+# --------------------------
+# Mientras se prepara un medio lento se muestra una vista previa: el primer
+# fotograma del GIF si el original ya está en la caché, o la miniatura que
+# genera Drive.
+
+PREVIEW_MAX_DIM = 480
+
+def drive_thumbnail_url(file: dict) -> str:
+    return f"https://drive.google.com/thumbnail?id={file['id']}&sz=w{PREVIEW_MAX_DIM}"
+
+def still_cache_key(file: dict) -> str:
+    return f"still_{media_key(file)}_{PREVIEW_MAX_DIM}.jpg"
+
+def get_cached_still(file: dict) -> Optional[str]:
+    """Primer fotograma reducido de un GIF cuyo original está en la caché; None si no lo está."""
+    if Image is None:
+        return None
+    key = still_cache_key(file)
+    cached = media_cache.get(key)
+    if cached:
+        return cached
+    src = media_cache.get(original_cache_key(file))
+    if not src:
+        return None
+    out_path = None
+    try:
+        out_path = scratch.new_path("_still.jpg")
+        with Image.open(src) as im:
+            frame = im.convert("RGB")
+            frame.thumbnail((PREVIEW_MAX_DIM, PREVIEW_MAX_DIM))
+            frame.save(out_path, "JPEG", quality=75)
+        return media_cache.put(key, out_path)
+    except Exception as e:
+        logger.debug("No se pudo extraer el fotograma de %s: %s", file.get("name"), e)
+        return None
+    finally:
+        if out_path:
+            scratch.release(out_path)
+
+# ==========================
+# Planificador de trabajo pesado
+# ==========================
+# Descargas y compresiones pasan por un único pool con prioridades: los
+# comandos de usuarios van antes que los auto-posts, y un hueco del pool queda
+# siempre libre para ellos. Según la profundidad de la cola y la espera, el bot
+# entra en modos degradados que abaratan cada envío.
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCHEDULED = 1
+
+LOAD_NORMAL = "normal"
+LOAD_DEGRADED = "degraded"    # se omiten GIFs que habría que comprimir
+LOAD_SHEDDING = "shedding"    # además, solo imágenes estáticas si hay
+
+class WorkScheduler:
+    """Pool de hilos con cola de prioridad para trabajo bloqueante.
+
+    Todo el estado se toca desde el event loop; los hilos solo ejecutan `fn`.
+    """
+
+    def __init__(self, workers: int, degrade_depth: int, degrade_wait: float,
+                 shed_depth: int, shed_wait: float, reserved_interactive: int = 1):
+        self.workers = max(1, workers)
+        self.reserved_interactive = min(reserved_interactive, self.workers - 1)
+        self.degrade_depth = degrade_depth
+        self.degrade_wait = degrade_wait
+        self.shed_depth = shed_depth
+        self.shed_wait = shed_wait
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="lukeybot-work")
+        self._queue = []  # (prioridad, secuencia, encolado monotonic, future, fn, args)
+        self._seq = itertools.count()
+        self._running = 0
+        self._running_background = 0
+        self._wait_ewma = 0.0
+        self._wait_updated = time.monotonic()
+        self._level = LOAD_NORMAL
+        self.submitted = {PRIORITY_INTERACTIVE: 0, PRIORITY_SCHEDULED: 0}
+        self.max_depth = 0
+        self.level_changes = 0
+        self.shed_counts = {}
+
+    async def run(self, priority: int, fn, *args):
+        """Encola `fn(*args)` y espera su resultado."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), time.monotonic(), future, fn, args))
+        self.submitted[priority] = self.submitted.get(priority, 0) + 1
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._dispatch()
+        return await future
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self._queue and self._running < self.workers:
+            priority, _, queued_at, future, fn, args = self._queue[0]
+            background = priority > PRIORITY_INTERACTIVE
+            if background and self._running_background >= self.workers - self.reserved_interactive:
+                # La cabeza es de baja prioridad (no hay interactivos esperando) y el resto está reservado
+                break
+            heapq.heappop(self._queue)
+            if future.cancelled():
+                continue
+            self._wait_ewma = 0.8 * self._recent_wait() + 0.2 * (time.monotonic() - queued_at)
+            self._wait_updated = time.monotonic()
+            self._running += 1
+            if background:
+                self._running_background += 1
+            job = loop.run_in_executor(self._executor, fn, *args)
+            job.add_done_callback(lambda job, future=future, background=background: self._finished(job, future, background))
+
+    def _finished(self, job, future, background: bool):
+        self._running -= 1
+        if background:
+            self._running_background -= 1
+        if future.cancelled():
+            # Nadie espera el resultado: liberar lo que haya creado (p. ej. temporales)
+            if not job.cancelled() and job.exception() is None and hasattr(job.result(), "cleanup"):
+                job.result().cleanup()
+        elif job.cancelled():
+            future.cancel()
+        elif job.exception() is not None:
+            future.set_exception(job.exception())
+        else:
+            future.set_result(job.result())
+        self._dispatch()
+
+    # La media de espera se reduce a la mitad cada tanto sin trabajos nuevos
+    WAIT_HALF_LIFE_SECONDS = 30.0
+
+    def _recent_wait(self) -> float:
+        idle = time.monotonic() - self._wait_updated
+        return self._wait_ewma * 0.5 ** (idle / self.WAIT_HALF_LIFE_SECONDS)
+
+    def queue_wait(self) -> float:
+        """Espera estimada: la media reciente o la del trabajo más antiguo en cola."""
+        oldest = min((queued_at for _, _, queued_at, _, _, _ in self._queue), default=None)
+        current = time.monotonic() - oldest if oldest is not None else 0.0
+        return max(self._recent_wait(), current)
+
+    def load_level(self) -> str:
+        depth, wait = len(self._queue), self.queue_wait()
+        if depth >= self.shed_depth or wait >= self.shed_wait:
+            level = LOAD_SHEDDING
+        elif depth >= self.degrade_depth or wait >= self.degrade_wait:
+            level = LOAD_DEGRADED
+        else:
+            level = LOAD_NORMAL
+        if level != self._level:
+            self.level_changes += 1
+            log = logger.info if level == LOAD_NORMAL else logger.warning
+            log(f"Carga: {self._level} -> {level} (cola {depth}, espera {wait:.1f}s)")
+            self._level = level
+        return level
+
+    def record_shed(self, action: str):
+        self.shed_counts[action] = self.shed_counts.get(action, 0) + 1
+
+    def metrics(self) -> dict:
+        return {
+            "level": self._level,
+            "queue_depth": len(self._queue),
+            "max_queue_depth": self.max_depth,
+            "running": self._running,
+            "queue_wait_seconds": round(self.queue_wait(), 2),
+            "submitted_interactive": self.submitted.get(PRIORITY_INTERACTIVE, 0),
+            "submitted_scheduled": self.submitted.get(PRIORITY_SCHEDULED, 0),
+            "level_changes": self.level_changes,
+            "shed": dict(self.shed_counts),
+        }
+
+work_scheduler = WorkScheduler(WORK_CONCURRENCY, DEGRADE_QUEUE_DEPTH, DEGRADE_WAIT_SECONDS,
+                               SHED_QUEUE_DEPTH, SHED_WAIT_SECONDS)
+
+def shed_candidates(files, upload_limit: int) -> tuple:
+    """Aplica el modo de carga actual a los candidatos.
+
+    Devuelve (archivos, límite para GIFs): en modo degradado los GIFs deben
+    caber sin comprimir; en shedding se prefieren las imágenes estáticas
+    (límite 0: ningún GIF).
+    """
+    level = work_scheduler.load_level()
+    if level == LOAD_NORMAL:
+        return files, MAX_GIF_SIZE_BYTES
+    if level == LOAD_SHEDDING:
+        if files.candidates(0):
+            work_scheduler.record_shed("static_only")
+            return files, 0
+    work_scheduler.record_shed("skip_compression")
+    return files, min(upload_limit, MAX_GIF_SIZE_BYTES)
+
+@tasks.loop(hours=1)
+async def log_work_metrics():
+    logger.info("Planificador", extra={"metrics": work_scheduler.metrics()})
+    logger.info("Catálogos", extra={"metrics": catalog_pool.metrics()})
+    logger.info("Transcoders", extra={"metrics": transcoder_metrics()})
+
+# ==========================
+# Preparación y envío de medios
+# ==========================
+
+class MediaUnavailable(Exception):
+    """El medio elegido no puede enviarse; el mensaje es apto para el usuario."""
+
+class MediaStyle:
+    """Presentación de un tipo de post: frases, colores, reacción y textos."""
+
+    def __init__(self, quotes, color_ranges, reaction=None, content_prefix="",
+                 description=None, label="GIF", empty_message="No images found in Drive folder."):
+        self.quotes = quotes
+        self.color_ranges = color_ranges
+        self.reaction = reaction
+        self.content_prefix = content_prefix
+        self.description = description
+        self.label = label
+        self.empty_message = empty_message
+
+    def quote(self) -> str:
+        return random.choice(self.quotes)
+
+    def color(self) -> discord.Color:
+        return discord.Color.from_rgb(*(random.randint(lo, hi) for lo, hi in self.color_ranges))
+
+MEDIA_STYLES = {
+    "luke": MediaStyle(
+        RANDOM_QUOTES, ((0, 255), (0, 255), (0, 255)), reaction="✨",
+    ),
+    "spicyluke": MediaStyle(
+        SPICY_QUOTES, ((180, 255), (0, 80), (50, 200)), reaction="✨", content_prefix="🔥 ",
+        description="🔥 Spicy Mode Activated 🔥", label="GIF spicy",
+        empty_message="No spicy material found in Drive 😳",
+    ),
+    "almendras": MediaStyle(
+        ALMONDS_QUOTES, ((150, 220), (120, 180), (80, 140)), reaction="🌰",
+        empty_message="No hay almendras en el Drive 🌰",
+    ),
+    "almonds": MediaStyle(ALMONDS_QUOTES, ((150, 255), (100, 200), (50, 150))),
+    "kcd": MediaStyle(KCD_QUOTES, ((100, 200), (100, 180), (50, 120))),
+}
+
+class PreparedMedia:
+    """Medio listo para enviar: un adjunto local (`path`) o una URL a incrustar."""
+
+    def __init__(self, file: dict, path: Optional[str] = None, filename: Optional[str] = None,
+                 url: Optional[str] = None, temp_paths=()):
+        self.file = file
+        self.path = path
+        self.filename = filename or file["name"]
+        self.url = url
+        self.temp_paths = list(temp_paths)
+
+    @property
+    def is_gif(self) -> bool:
+        return self.file.get("mimeType") == "image/gif"
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.path) if self.path else 0
+
+    def cleanup(self):
+        for path in self.temp_paths:
+            scratch.release(path)
+        self.temp_paths.clear()
+
+def compressed_cache_key(file: dict, max_bytes: int) -> str:
+    return f"gif_{media_key(file)}_{max_bytes}.gif"
+
+def prepare_media(file: dict, max_bytes: int, label: str = "GIF") -> PreparedMedia:
+    """Descarga/comprime/redimensiona el archivo para enviarlo a Discord.
+
+    Bloqueante: llamar desde un hilo (asyncio.to_thread). Lanza MediaUnavailable
+    con un mensaje para el usuario si el medio no puede enviarse.
+    """
+    if file["mimeType"] != "image/gif":
+        variant = get_image_variant(file)
+        if variant:
+            stem = os.path.splitext(file["name"])[0]
+            return PreparedMedia(file, path=variant, filename=f"{stem}.{IMAGE_VARIANT_FORMAT}")
+        if drive_breaker.degraded:
+            # Con Drive caído, mejor adjuntar una copia local que una URL que no cargará
+            cached = media_cache.get(original_cache_key(file))
+            if cached:
+                return PreparedMedia(file, path=cached)
+        return PreparedMedia(file, url=drive_download_url(file["id"]))
+
+    # GIF ya comprimido para este límite (por cualquier copia idéntica): ni descarga ni compresión
+    compressed_key = compressed_cache_key(file, max_bytes)
+    cached = media_cache.get(compressed_key)
+    if cached:
+        return PreparedMedia(file, path=cached)
+
+    size = int(file.get("size") or 0)
+    if (STREAM_TRANSCODE and size > max_bytes and ffmpeg_available()
+            and not media_cache.contains(original_cache_key(file))):
+        # Demasiado grande y aún sin descargar: comprimir mientras llega
+        with media_locks.get(compressed_key):
+            cached = media_cache.get(compressed_key)
+            if not cached:
+                streamed = stream_transcode_gif(file, max_bytes)
+                if streamed:
+                    cached = media_cache.put(compressed_key, streamed)
+                    scratch.release(streamed)
+        if cached:
+            return PreparedMedia(file, path=cached)
+
+    src, src_is_temp = fetch_original(file, ".gif")
+    if not src:
+        raise MediaUnavailable(f"No se pudo descargar el {label}.")
+    temp_paths = [src] if src_is_temp else []
+    try:
+        tmp_size = os.path.getsize(src)
+        # If exceeds Discord per-file limit, attempt to compress to max_bytes
+        if tmp_size > max_bytes:
+            if not transcoders_available():
+                raise MediaUnavailable(f"{label} omitido — demasiado grande ({tmp_size/1024/1024:.1f} MB) y no hay ningún compresor disponible.")
+            logger.debug("%s %s es %d bytes, intentando comprimir a %d bytes", label, file['name'], tmp_size, max_bytes)
+            with media_locks.get(compressed_key):
+                cached = media_cache.get(compressed_key)
+                if not cached:
+                    compressed_file = compress_gif(src, max_bytes)
+                    if not compressed_file:
+                        raise MediaUnavailable(f"{label} omitido — no fue posible reducirlo por debajo de {max_bytes/1024/1024:.0f} MB.")
+                    cached = media_cache.put(compressed_key, compressed_file)
+                    scratch.release(compressed_file)
+            for path in temp_paths:
+                scratch.release(path)
+            return PreparedMedia(file, path=cached)
+
+        if tmp_size > MAX_GIF_SIZE_BYTES:
+            raise MediaUnavailable(f"{label} omitido — demasiado grande ({tmp_size/1024/1024:.1f} MB). Límite: {MAX_GIF_MB} MB.")
+
+        return PreparedMedia(file, path=src, temp_paths=temp_paths)
+    except BaseException:
+        for path in temp_paths:
+            scratch.release(path)
+        raise
+
+# --------------------------
+# Límite de subida por destino
+# --------------------------
+# Cada servidor acepta archivos según su nivel de boost (guild.filesize_limit).
+# Los límites se redondean a niveles fijos para que un GIF comprimido en la
+# caché sirva a todos los servidores del mismo nivel.
+
+UPLOAD_TIERS = sorted({DISCORD_MAX_BYTES, *(mb * 1024 * 1024 for mb in (10, 25, 50, 100))})
+# Un 413 rebaja el límite del servidor durante este tiempo (puede cambiar de nivel)
+LEARNED_LIMIT_TTL_SECONDS = 6 * 3600
+
+# guild_id (None para DMs) -> (límite en bytes, caducidad monotonic)
+_learned_upload_limits = {}
+
+def _tier_at_most(limit: int) -> int:
+    """Mayor nivel que no supera `limit` (o el propio límite si es menor que todos)."""
+    return max((t for t in UPLOAD_TIERS if t <= limit), default=limit)
+
+def _guild_key(destination):
+    guild = getattr(destination, "guild", None)
+    return guild.id if guild is not None else None
+
+def upload_limit_for(destination) -> int:
+    """Tamaño máximo de adjunto para un canal, contexto o interacción."""
+    guild = getattr(destination, "guild", None)
+    limit = DISCORD_MAX_BYTES
+    if UPLOAD_LIMIT_PER_GUILD and guild is not None:
+        limit = _tier_at_most(guild.filesize_limit)
+    learned = _learned_upload_limits.get(_guild_key(destination))
+    if learned:
+        learned_limit, expires = learned
+        if time.monotonic() < expires:
+            limit = min(limit, learned_limit)
+        else:
+            _learned_upload_limits.pop(_guild_key(destination), None)
+    return limit
+
+def record_payload_too_large(destination, attempted_bytes: int) -> int:
+    """Registra un 413 y devuelve el nivel inmediatamente inferior a lo intentado."""
+    below = [t for t in UPLOAD_TIERS if t < attempted_bytes]
+    limit = max(below) if below else attempted_bytes * 9 // 10
+    _learned_upload_limits[_guild_key(destination)] = (limit, time.monotonic() + LEARNED_LIMIT_TTL_SECONDS)
+    logger.warning(f"413 al subir {attempted_bytes/1024/1024:.1f} MB a {_guild_key(destination)}; "
+                   f"límite rebajado a {limit/1024/1024:.1f} MB")
+    return limit
+
+async def _reprepare(prepared: PreparedMedia, max_bytes: int, style: MediaStyle,
+                     priority: int = PRIORITY_INTERACTIVE) -> PreparedMedia:
+    fresh = await work_scheduler.run(priority, prepare_media, prepared.file, max_bytes, style.label)
+    prepared.cleanup()
+    return fresh
+
+async def send_within_limit(destination, prepared: PreparedMedia, style: MediaStyle, quote: str,
+                            priority: int = PRIORITY_INTERACTIVE):
+    """Envía respetando el límite de subida del destino.
+
+    Si el adjunto no cabe se vuelve a preparar para ese límite; un 413 rebaja
+    el límite del servidor y se reintenta una vez. Devuelve (mensaje, prepared):
+    el llamador debe limpiar el `prepared` devuelto, que puede ser otro.
+    """
+    original = prepared
+    try:
+        limit = upload_limit_for(destination)
+        if prepared.path and prepared.size > limit:
+            prepared = await _reprepare(prepared, limit, style, priority)
+        try:
+            return await send_prepared(destination, prepared, style, quote), prepared
+        except discord.HTTPException as e:
+            if e.status != 413 or not prepared.path:
+                raise
+            limit = record_payload_too_large(destination, prepared.size)
+            prepared = await _reprepare(prepared, limit, style, priority)
+            return await send_prepared(destination, prepared, style, quote), prepared
+    except BaseException:
+        if prepared is not original:
+            prepared.cleanup()
+        raise
+
+async def send_prepared(destination, prepared: PreparedMedia, style: MediaStyle, quote: str):
+    """Envía un medio preparado a un canal o contexto con la presentación del estilo."""
+    if prepared.is_gif and prepared.path:
+        return await destination.send(
+            content=f"{style.content_prefix}{quote}",
+            file=discord.File(prepared.path, filename=prepared.filename),
+        )
+
+    embed = discord.Embed(title=quote, description=style.description, color=style.color())
+    if prepared.path:
+        embed.set_image(url=f"attachment://{prepared.filename}")
+        return await destination.send(embed=embed, file=discord.File(prepared.path, filename=prepared.filename))
+    embed.set_image(url=prepared.url)
+    return await destination.send(embed=embed)
+
+# --------------------------
+# Entrega progresiva
+# --------------------------
+# Si preparar el medio tarda más de PROGRESSIVE_DELAY_MS se responde ya con la
+# frase y una vista previa, y ese mismo mensaje se edita con el medio final.
+# Pasado PROGRESSIVE_CUTOFF_SECONDS la vista previa se queda como respuesta;
+# la preparación sigue en segundo plano y deja el resultado en la caché.
+
+PREVIEW_PENDING_FOOTER = "⏳ Preparando el archivo completo…"
+PREVIEW_FINAL_FOOTER = "Vista previa: el archivo completo no estuvo a tiempo."
+
+class PreviewDestination:
+    """Adapta un mensaje de vista previa a la interfaz `send`: enviar es editarlo."""
+
+    def __init__(self, message, guild):
+        self.message = message
+        self.guild = guild
+
+    async def send(self, content=None, embed=None, file=None):
+        return await self.message.edit(content=content, embed=embed, attachments=[file] if file else [])
+
+async def send_preview(destination, file: dict, style: MediaStyle, quote: str):
+    embed = discord.Embed(title=quote, description=style.description, color=style.color())
+    embed.set_footer(text=PREVIEW_PENDING_FOOTER)
+    still = None
+    if file.get("mimeType") == "image/gif":
+        still = await asyncio.to_thread(get_cached_still, file)
+    if still:
+        embed.set_image(url="attachment://preview.jpg")
+        return await destination.send(embed=embed, file=discord.File(still, filename="preview.jpg"))
+    embed.set_image(url=drive_thumbnail_url(file))
+    return await destination.send(embed=embed)
+
+async def _finalize_preview(preview, footer: str = PREVIEW_FINAL_FOOTER):
+    """Deja la vista previa como respuesta definitiva, con `footer` explicando por qué."""
+    try:
+        embed = preview.embeds[0]
+        embed.set_footer(text=footer)
+        await preview.edit(embed=embed)
+    except Exception as e:
+        logger.debug("No se pudo actualizar la vista previa: %s", e)
+
+def _release_when_done(task: asyncio.Future):
+    """La preparación abandonada sigue hasta el final; libera lo que produzca."""
+    def done(t):
+        if not t.cancelled() and t.exception() is None:
+            t.result().cleanup()
+    task.add_done_callback(done)
+
+async def send_progressive(destination, file: dict, max_bytes: int, style: MediaStyle):
+    """Prepara y envía `file`, con vista previa si la preparación es lenta.
+
+    Devuelve (mensaje, prepared) como send_within_limit; prepared es None si
+    la vista previa se quedó como respuesta.
+    """
+    task = asyncio.ensure_future(
+        work_scheduler.run(PRIORITY_INTERACTIVE, prepare_media, file, max_bytes, style.label))
+    quote = style.quote()
+    started = time.monotonic()
+    done, _ = await asyncio.wait({task}, timeout=PROGRESSIVE_DELAY_MS / 1000)
+    if done:
+        return await send_within_limit(destination, task.result(), style, quote)
+
+    try:
+        preview = await send_preview(destination, file, style, quote)
+        done, _ = await asyncio.wait({task}, timeout=max(0.0, PROGRESSIVE_CUTOFF_SECONDS - (time.monotonic() - started)))
+    except BaseException:
+        _release_when_done(task)
+        raise
+    if not done:
+        _release_when_done(task)
+        logger.info(f"{file.get('name')}: la vista previa se queda como respuesta "
+                    f"({PROGRESSIVE_CUTOFF_SECONDS:.0f}s sin terminar)")
+        await _finalize_preview(preview)
+        return preview, None
+    error = task.exception()
+    if error is not None:
+        logger.warning(f"{file.get('name')}: la vista previa se queda como respuesta: {error}")
+        # MediaUnavailable trae el mensaje para el usuario (demasiado grande, Drive caído...)
+        await _finalize_preview(preview, str(error) if isinstance(error, MediaUnavailable) else PREVIEW_FINAL_FOOTER)
+        return preview, None
+
+    prepared = task.result()
+    try:
+        message, prepared = await send_within_limit(
+            PreviewDestination(preview, getattr(destination, "guild", None)), prepared, style, quote)
+    except Exception as e:
+        prepared.cleanup()
+        logger.warning(f"No se pudo sustituir la vista previa de {file.get('name')}: {e}")
+        await _finalize_preview(preview)
+        return preview, None
+    logger.debug("%s entregado tras vista previa en %.1fs", file.get("name"), time.monotonic() - started)
+    return message, prepared
+
+# ==========================
+# Programación de auto-posts
+# ==========================
+# Las programaciones se cargan de AUTO_POST_SCHEDULES_FILE (JSON). Ejemplo:
+#
+#   [
+#     {"name": "almonds", "style": "almonds", "channels": [123, 456], "interval_hours": 6},
+#     {"name": "kcd", "style": "kcd", "channels": [789], "cron": "0 */8 * * *",
+#      "quotes": "kcd", "jitter_seconds": 600}
+#   ]
+#
+# `quotes` puede ser el nombre de un pool predefinido o una lista de frases.
+# Sin archivo se usan AUTO_POST_CHANNEL_ID (6h) y KCD_POST_CHANNEL_ID (8h).
+
+QUOTE_POOLS = {
+    "random": RANDOM_QUOTES,
+    "spicy": SPICY_QUOTES,
+    "almonds": ALMONDS_QUOTES,
+    "kcd": KCD_QUOTES,
+}
+
+class CronSpec:
+    """Expresión cron de 5 campos (minuto hora día mes día-semana), evaluada en UTC.
+
+    Soporta `*`, listas (`1,15`), rangos (`9-17`) y pasos (`*/8`, `0-30/10`).
+    """
+
+    FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"Expresión cron inválida (se esperan 5 campos): {expr!r}")
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(field, lo, hi) for field, (lo, hi) in zip(fields, self.FIELD_RANGES)
+        )
+        # Como en cron clásico: si día y día-semana están restringidos, basta con uno
+        self._day_or = fields[2] != "*" and fields[4] != "*"
+
+    @staticmethod
+    def _parse(field: str, lo: int, hi: int) -> frozenset:
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_str = part.split("/", 1)
+                step = int(step_str)
+            if part == "*":
+                start, end = lo, hi
+            elif "-" in part:
+                a, b = part.split("-", 1)
+                start, end = int(a), int(b)
+            else:
+                start = int(part)
+                end = hi if step > 1 else start
+            if step < 1 or start < lo or end > hi or start > end:
+                raise ValueError(f"Campo cron fuera de rango: {field!r}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def _day_matches(self, dt: datetime) -> bool:
+        dom = dt.day in self.days
+        dow = (dt.weekday() + 1) % 7 in self.weekdays  # cron: 0 = domingo
+        return (dom or dow) if self._day_or else (dom and dow)
+
+    def next_after(self, ts: float) -> float:
+        """Siguiente instante (epoch) estrictamente posterior a `ts` que cumple la expresión."""
+        dt = datetime.fromtimestamp(ts, timezone.utc).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 4)
+        while dt < limit:
+            if dt.month not in self.months or not self._day_matches(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError(f"La expresión cron {self.expr!r} nunca se cumple")
+
+class PostSchedule:
+    """Un auto-post: conjunto de canales, periodicidad (intervalo o cron) y pool de frases."""
+
+    def __init__(self, name: str, channel_ids, style: MediaStyle, quotes,
+                 interval_seconds: Optional[float] = None, cron: Optional[CronSpec] = None,
+                 jitter_seconds: float = 0):
+        if (interval_seconds is None) == (cron is None):
+            raise ValueError(f"Programación {name}: indica 'interval_hours'/'interval_minutes' o 'cron'")
+        self.name = name
+        self.channel_ids = list(channel_ids)
+        self.style = style
+        self.quotes = quotes
+        self.interval_seconds = interval_seconds
+        self.cron = cron
+        self.jitter_seconds = jitter_seconds
+
+    def first_run(self, now: float) -> float:
+        """Primera ejecución, desplazada al azar para no arrancar todo a la vez."""
+        jitter = random.uniform(0, self.jitter_seconds)
+        if self.cron:
+            return self.cron.next_after(now) + jitter
+        return now + jitter
+
+    def next_run(self, last: float) -> float:
+        if self.cron:
+            return self.cron.next_after(last) + random.uniform(0, self.jitter_seconds)
+        return last + self.interval_seconds
+
+    def quote(self) -> str:
+        return random.choice(self.quotes)
+
+def _schedule_from_dict(data: dict) -> PostSchedule:
+    name = data["name"]
+    style_name = data.get("style", name)
+    if style_name not in MEDIA_STYLES:
+        raise ValueError(f"Programación {name}: estilo desconocido {style_name!r}")
+    style = MEDIA_STYLES[style_name]
+
+    quotes = data.get("quotes", style.quotes)
+    if isinstance(quotes, str):
+        if quotes not in QUOTE_POOLS:
+            raise ValueError(f"Programación {name}: pool de frases desconocido {quotes!r}")
+        quotes = QUOTE_POOLS[quotes]
+    if not quotes:
+        raise ValueError(f"Programación {name}: el pool de frases está vacío")
+
+    interval = None
+    if "interval_hours" in data:
+        interval = float(data["interval_hours"]) * 3600
+    elif "interval_minutes" in data:
+        interval = float(data["interval_minutes"]) * 60
+    cron = CronSpec(data["cron"]) if data.get("cron") else None
+
+    return PostSchedule(
+        name, [int(c) for c in data.get("channels", [])], style, quotes,
+        interval_seconds=interval, cron=cron,
+        jitter_seconds=float(data.get("jitter_seconds", SCHEDULE_JITTER_SECONDS)),
+    )
+
+def load_schedules() -> list:
+    """Carga las programaciones del archivo JSON o, si no existe, de las variables de entorno."""
+    if os.path.exists(AUTO_POST_SCHEDULES_FILE):
+        with open(AUTO_POST_SCHEDULES_FILE, encoding="utf-8") as f:
+            schedules = [_schedule_from_dict(d) for d in json.load(f)]
+        logger.info(f"Cargadas {len(schedules)} programaciones desde {AUTO_POST_SCHEDULES_FILE}")
+    else:
+        schedules = []
+        if AUTO_POST_CHANNEL_ID:
+            schedules.append(_schedule_from_dict({"name": "almonds", "channels": [AUTO_POST_CHANNEL_ID], "interval_hours": 6}))
+        else:
+            logger.info("AUTO_POST_CHANNEL_ID no configurado, auto-post ALMONDS deshabilitado")
+        if KCD_POST_CHANNEL_ID:
+            schedules.append(_schedule_from_dict({"name": "kcd", "channels": [KCD_POST_CHANNEL_ID], "interval_hours": 8}))
+        else:
+            logger.info("KCD_POST_CHANNEL_ID no configurado, auto-post KCD deshabilitado")
+    names = [s.name for s in schedules]
+    if len(names) != len(set(names)):
+        raise ValueError("Hay programaciones con nombres duplicados")
+    return [s for s in schedules if s.channel_ids]
+
+try:
+    AUTO_POST_SCHEDULES = load_schedules()
+except (OSError, ValueError, KeyError, TypeError) as e:
+    logger.error(f"Configuración de auto-posts inválida: {e}")
+    raise RuntimeError(f"Configuración de auto-posts inválida: {e}")
+
+class RateLimiter:
+    """Token bucket asíncrono para no superar el límite global de peticiones de Discord."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Discord permite ~50 peticiones/s globales; los buckets por canal los gestiona discord.py
+fanout_limiter = RateLimiter(rate=FANOUT_RATE_PER_SECOND, burst=max(1, int(FANOUT_RATE_PER_SECOND)))
+FANOUT_CONCURRENCY = 10
+
+_gateway_checked = False
+
+async def check_gateway_settings():
+    """Comprueba que cada comando y auto-post puede funcionar con los intents y cachés activos.
+
+    Verifica que el cliente usa las opciones del modo configurado, que los
+    comandos con "!" reciben el contenido de los mensajes y que cada canal de
+    auto-post se resuelve (por caché o por la API) y admite enviar adjuntos.
+    Los problemas se registran como errores; no impiden arrancar.
+    """
+    global _gateway_checked
+    if _gateway_checked:
+        return
+    _gateway_checked = True
+    problems = []
+    state = bot._connection
+
+    expected = build_gateway_options(LOW_MEMORY_MODE, COMMAND_MODE)
+    if bot.intents.value != expected["intents"].value:
+        problems.append(f"intents {bot.intents.value}, se esperaban {expected['intents'].value}")
+    if LOW_MEMORY_MODE:
+        if state.max_messages != expected["max_messages"]:
+            problems.append(f"caché de mensajes {state.max_messages}, se esperaba {expected['max_messages']}")
+        if state._chunk_guilds:
+            problems.append("el chunking de miembros al arrancar sigue activo")
+        if state.member_cache_flags.value:
+            problems.append("la caché de miembros sigue activa")
+
+    if COMMAND_MODE in ("prefix", "both"):
+        if not (bot.intents.guild_messages and bot.intents.message_content):
+            names = ", ".join(f"!{command.name}" for command in bot.commands)
+            problems.append(f"{names} no recibirán mensajes sin los intents de mensajes y message_content")
+    if COMMAND_MODE in ("slash", "both") and not _slash_synced:
+        problems.append("los comandos slash no se sincronizaron")
+
+    from_api = 0
+    for schedule in AUTO_POST_SCHEDULES:
+        for channel_id in schedule.channel_ids:
+            channel = bot.get_channel(channel_id)
+            if channel is None:
+                try:
+                    channel = await bot.fetch_channel(channel_id)
+                    from_api += 1
+                except discord.HTTPException as e:
+                    problems.append(f"auto-post {schedule.name}: canal {channel_id} inaccesible ({e})")
+                    continue
+            guild = getattr(channel, "guild", None)
+            if guild is None or guild.me is None:
+                continue
+            permissions = channel.permissions_for(guild.me)
+            missing = [name for name in ("send_messages", "embed_links", "attach_files")
+                       if not getattr(permissions, name)]
+            if missing:
+                problems.append(f"auto-post {schedule.name}: faltan permisos en {channel_id}: {', '.join(missing)}")
+
+    for problem in problems:
+        logger.error(f"Configuración del gateway: {problem}")
+    channels = sum(len(s.channel_ids) for s in AUTO_POST_SCHEDULES)
+    logger.info(
+        f"Gateway: intents={bot.intents.value}, caché de mensajes={state.max_messages}, "
+        f"chunking={state._chunk_guilds}, {channels} canales de auto-post ({from_api} pedidos a la API), "
+        f"{len(problems)} problema(s)"
+    )
+
+# ==========================
+# Watchdog del event loop
+# ==========================
+# Un latido en el loop mide cuánto se retrasa respecto a lo programado (lag)
+# y lo acumula en un histograma. Un hilo aparte vigila el latido: si el loop
+# lleva más de LOOP_LAG_THRESHOLD_MS sin latir, algo síncrono lo está
+# bloqueando y se registra la pila del hilo del loop en ese momento.
+
+class LoopWatchdog:
+    """Mide el lag del event loop y captura la pila de quien lo bloquea."""
+
+    # Límites superiores de los buckets del histograma, en ms
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, interval: float, threshold: float, report_seconds: float = 3600):
+        self.interval = interval
+        self.threshold = threshold
+        self.report_seconds = report_seconds
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)  # el último es +inf
+        self.max_lag_ms = 0.0
+        self.stalls = 0
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="lukeybot-watchdog", daemon=True).start()
+        logger.info(f"Watchdog del loop activo (umbral {self.threshold * 1000:.0f} ms)")
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    def record(self, lag_ms: float):
+        for i, bound in enumerate(self.BUCKETS_MS):
+            if lag_ms <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+
+    async def _heartbeat(self):
+        last_report = time.monotonic()
+        while not self._stop.is_set():
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._last_beat = now
+            self.record(max(0.0, now - expected) * 1000)
+            if now - last_report >= self.report_seconds:
+                last_report = now
+                logger.info("Lag del event loop", extra={"metrics": self.metrics()})
+
+    def _watch(self):
+        captured_beat = None
+        while not self._stop.wait(self.interval / 2):
+            beat = self._last_beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or beat == captured_beat:
+                continue
+            # Una captura por bloqueo: el latido no ha vuelto desde `beat`
+            captured_beat = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(pila no disponible)"
+            logger.warning(
+                "Event loop bloqueado %.0f ms", stalled * 1000,
+                extra={"stack": stack},
+            )
+
+    def percentile(self, p: float) -> float:
+        """Límite superior (ms) del bucket que contiene el percentil `p`."""
+        total = sum(self.counts)
+        if not total:
+            return 0.0
+        running = 0
+        for i, count in enumerate(self.counts):
+            running += count
+            if running >= total * p:
+                return float(self.BUCKETS_MS[i]) if i < len(self.BUCKETS_MS) else self.max_lag_ms
+        return self.max_lag_ms
+
+    def metrics(self) -> dict:
+        bounds = [str(b) for b in self.BUCKETS_MS] + ["+inf"]
+        return {
+            "histogram_ms": dict(zip(bounds, self.counts)),
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_lag_ms, 1),
+            "stalls": self.stalls,
+        }
+
+loop_watchdog = LoopWatchdog(LOOP_WATCHDOG_INTERVAL_MS / 1000, LOOP_LAG_THRESHOLD_MS / 1000)
+
+def latency_report() -> str:
+    """Texto de !ping: latencia del gateway y, con el watchdog, lag del loop."""
+    text = f"Pong! Latencia: {round(bot.latency * 1000)} ms"
+    if LOOP_WATCHDOG:
+        text += f" · lag del loop p99 ≤ {loop_watchdog.percentile(0.99):.0f} ms (máx {loop_watchdog.max_lag_ms:.0f} ms)"
+    return text
+
+# ==========================
+# Eventos y comandos
+# ==========================
 
 @bot.event
 async def on_ready():
@@ -406,20 +3421,21 @@ async def on_ready():
         await bot.change_presence(activity=discord.Game(name="summoning Luke"))
     except Exception as e:
         logger.error(f"Error cambiando presencia: {e}")
-    
-    # Iniciar tarea de auto-post si está configurado el canal
-    if AUTO_POST_CHANNEL_ID:
-        auto_post_almonds.start()
-        logger.info(f"Auto-post ALMONDS iniciado para canal ID: {AUTO_POST_CHANNEL_ID}")
-    else:
-        logger.info("AUTO_POST_CHANNEL_ID no configurado, auto-post ALMONDS deshabilitado")
-    
-    # Iniciar tarea de auto-post KCD cada 8h
-    if KCD_POST_CHANNEL_ID:
-        auto_post_kcd.start()
-        logger.info(f"Auto-post KCD iniciado para canal ID: {KCD_POST_CHANNEL_ID}")
-    else:
-        logger.info("KCD_POST_CHANNEL_ID no configurado, auto-post KCD deshabilitado")
+
+    if LOOP_WATCHDOG:
+        loop_watchdog.start()
+    await sync_slash_commands()
+    await check_gateway_settings()
+    if not log_work_metrics.is_running():
+        log_work_metrics.start()
+
+    # Iniciar el programador de auto-posts si hay programaciones
+    if AUTO_POST_SCHEDULES and not auto_post_scheduler.is_running():
+        auto_post_scheduler.start()
+        total = sum(len(s.channel_ids) for s in AUTO_POST_SCHEDULES)
+        logger.info(f"Auto-post iniciado: {len(AUTO_POST_SCHEDULES)} programaciones, {total} canales")
+    elif not AUTO_POST_SCHEDULES:
+        logger.info("Sin programaciones de auto-post configuradas")
 
 @bot.event
 async def on_disconnect():
@@ -439,213 +3455,366 @@ async def on_command_error(ctx, error):
         return  # Ignorar comandos no encontrados
     elif isinstance(error, commands.MissingRequiredArgument):
         await ctx.send(f"Falta un argumento requerido: {error.param.name}")
+    elif isinstance(error, commands.BadArgument):
+        await ctx.send(f"Argumento inválido. Uso: `!{ctx.command} [1-{BATCH_MAX_ITEMS}]`")
     else:
         logger.error(f"Error en comando {ctx.command}: {error}", exc_info=True)
         await ctx.send("Ocurrió un error al ejecutar el comando. Intenta de nuevo.")
 
 # ==========================
-# Tarea automática: Auto-post cada 6 horas
+# Flujo común: elegir, preparar y enviar
 # ==========================
 
-@tasks.loop(hours=6)
-async def auto_post_almonds():
-    """Post automático cada 6 horas con imagen random y frase ALMONDS."""
-    if not AUTO_POST_CHANNEL_ID:
-        return
-    
-    tmp_file = None
-    compressed_file = None
-    try:
-        channel = bot.get_channel(int(AUTO_POST_CHANNEL_ID))
-        if not channel:
-            logger.error(f"Canal {AUTO_POST_CHANNEL_ID} no encontrado")
-            return
+async def _selectable_files(files: MediaCatalog):
+    if drive_breaker.degraded:
+        # Drive degradado: elegir entre lo que ya está en la caché local (índice fuera del loop)
+        offline = await asyncio.to_thread(offline_view, files)
+        if offline:
+            return offline
+    return files
+
+async def pick_media_file(files, upload_limit: int = DISCORD_MAX_BYTES) -> dict:
+    """Elige un archivo aleatorio dentro del límite (fuera del event loop)."""
+    files, gif_limit = shed_candidates(await _selectable_files(files), upload_limit)
+    file = await asyncio.to_thread(select_random_file_with_limit, files, gif_limit)
+    if not file:
+        raise MediaUnavailable(f"No se encontró ninguna imagen/GIF dentro del límite de {gif_limit/1024/1024:.0f} MB.")
+    return file
+
+async def pick_and_prepare(files, max_bytes: int, style: MediaStyle,
+                           priority: int = PRIORITY_INTERACTIVE) -> PreparedMedia:
+    """Elige un archivo aleatorio dentro del límite y lo prepara en el pool de trabajo."""
+    file = await pick_media_file(files, max_bytes)
+    return await work_scheduler.run(priority, prepare_media, file, max_bytes, style.label)
 
-        files = get_all_media_files_from_folder()
+async def send_random_media(ctx, style_name: str, count: int = 1):
+    """Implementación compartida de !luke, !spicyluke y !almendras.
+
+    `ctx` puede ser un contexto de comando o cualquier destino con `send`.
+    Con `count` > 1 se envía un lote (ver send_media_batch).
+    """
+    style = MEDIA_STYLES[style_name]
+    prepared = None
+    try:
+        guild = getattr(ctx, "guild", None)
+        folder_id = folder_config.resolve(guild.id if guild else None, style_name)
+        files = await asyncio.to_thread(get_all_media_files_from_folder, folder_id)
+        if DEBUG:
+            await ctx.send(f"[DEBUG] Archivos en Drive: {len(files)}")
         if not files:
-            logger.warning("No hay archivos en Drive para auto-post")
+            await ctx.send(style.empty_message)
             return
 
-        # Seleccionar archivo dentro del límite
-        file = select_random_file_with_limit(files, MAX_GIF_SIZE_BYTES)
-        if not file:
-            logger.warning(f"No se encontró archivo dentro del límite de {MAX_GIF_MB} MB")
+        if count > 1:
+            await send_media_batch(ctx, files, style, min(count, BATCH_MAX_ITEMS))
             return
 
-        url = f"https://drive.google.com/uc?export=download&id={file['id']}"
-        quote = random.choice(ALMONDS_QUOTES)
-
-        if file['mimeType'] == 'image/gif':
-            r = requests.get(url, stream=True, timeout=30)
-            if r.status_code == 200:
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.gif') as tmp:
-                    tmp_file = tmp.name
-                    register_temp_file(tmp_file)
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            tmp.write(chunk)
-                    tmp.flush()
-                    tmp_size = os.path.getsize(tmp.name)
-                    
-                    if tmp_size > DISCORD_MAX_BYTES:
-                        if ffmpeg_available():
-                            logger.debug(f"Auto-post GIF {file['name']} es {tmp_size} bytes, comprimiendo")
-                            compressed_file = compress_gif_with_ffmpeg(tmp.name, DISCORD_MAX_BYTES)
-                            if compressed_file and os.path.exists(compressed_file):
-                                comp_size = os.path.getsize(compressed_file)
-                                if comp_size <= DISCORD_MAX_BYTES:
-                                    await channel.send(content=quote, file=discord.File(compressed_file, filename=file['name']))
-                                    cleanup_temp_file(compressed_file)
-                                    cleanup_temp_file(tmp_file)
-                                    logger.info(f"Auto-post enviado: {quote}")
-                                    return
-                            logger.warning("Auto-post: compresión fallida")
-                            cleanup_temp_file(tmp_file)
-                            return
-                        else:
-                            logger.warning(f"Auto-post: GIF muy grande y ffmpeg no disponible")
-                            cleanup_temp_file(tmp_file)
-                            return
-                    
-                    if tmp_size > MAX_GIF_SIZE_BYTES:
-                        logger.warning(f"Auto-post: GIF muy grande ({tmp_size/1024/1024:.1f} MB)")
-                        cleanup_temp_file(tmp_file)
-                        return
-
-                    await channel.send(content=quote, file=discord.File(tmp.name, filename=file['name']))
-                    cleanup_temp_file(tmp_file)
-                    logger.info(f"Auto-post enviado: {quote}")
-            else:
-                logger.error("Auto-post: no se pudo descargar GIF")
+        limit = upload_limit_for(ctx)
+        if PROGRESSIVE_DELIVERY:
+            file = await pick_media_file(files, limit)
+            sent, prepared = await send_progressive(ctx, file, limit, style)
         else:
-            almonds_color = discord.Color.from_rgb(
-                random.randint(150, 255),
-                random.randint(100, 200),
-                random.randint(50, 150)
-            )
-            embed = discord.Embed(
-                title=quote,
-                color=almonds_color
-            )
-            embed.set_image(url=url)
-            await channel.send(embed=embed)
-            logger.info(f"Auto-post enviado: {quote}")
-            
+            prepared = await pick_and_prepare(files, limit, style)
+            sent, prepared = await send_within_limit(ctx, prepared, style, style.quote())
+        if style.reaction:
+            try:
+                await sent.add_reaction(style.reaction)
+            except Exception:
+                pass
+    except MediaUnavailable as e:
+        await ctx.send(str(e))
+    except ScratchQuotaExceeded as e:
+        logger.warning(f"Comando !{style_name} rechazado: {e}")
+        await ctx.send("El bot está procesando demasiados archivos ahora mismo. Intenta de nuevo en un momento.")
+    except requests.Timeout:
+        logger.error(f"Timeout descargando imagen ({style_name})")
+        await ctx.send("Timeout al descargar la imagen. Intenta de nuevo.")
     except Exception as e:
-        logger.error(f"Error en auto-post: {e}", exc_info=True)
+        logger.error(f"Error en comando !{style_name}: {e}", exc_info=True)
+        await ctx.send("Ocurrió un error. Intenta de nuevo.")
     finally:
-        if tmp_file:
-            cleanup_temp_file(tmp_file)
-        if compressed_file:
-            cleanup_temp_file(compressed_file)
-
-@auto_post_almonds.before_loop
-async def before_auto_post():
-    """Esperar a que el bot esté listo antes de iniciar el loop."""
-    await bot.wait_until_ready()
-    logger.info("Auto-post ALMONDS loop listo para iniciar")
+        if prepared:
+            prepared.cleanup()
+
+# --------------------------
+# Lotes: !luke N
+# --------------------------
+# Un lote lee el catálogo una vez, prepara los medios en paralelo y los agrupa
+# en el menor número de mensajes: Discord admite hasta 10 embeds y 10 adjuntos
+# por mensaje, con el límite de subida aplicado al total de los adjuntos.
+
+BATCH_MAX_ITEMS = 10
+BATCH_CONCURRENCY = 4
+
+def pack_batch(items: list, max_bytes: int, max_items: int = BATCH_MAX_ITEMS) -> list:
+    """Agrupa medios preparados en mensajes sin superar `max_items` ni `max_bytes` adjuntos.
+
+    First-fit decreasing: los adjuntos grandes se colocan primero y los medios
+    enlazados por URL (0 bytes) rellenan los huecos.
+    """
+    messages = []  # [bytes usados, medios]
+    for item in sorted(items, key=lambda i: i.size, reverse=True):
+        size = item.size
+        for message in messages:
+            if len(message[1]) < max_items and message[0] + size <= max_bytes:
+                message[0] += size
+                message[1].append(item)
+                break
+        else:
+            messages.append([size, [item]])
+    return [group for _, group in messages]
+
+async def _send_batch_message(destination, items: list, style: MediaStyle):
+    embeds, attachments = [], []
+    for i, item in enumerate(items):
+        embed = discord.Embed(title=style.quote(), description=style.description, color=style.color())
+        if item.path:
+            # Nombres únicos dentro del mensaje: dos copias pueden llamarse igual
+            filename = f"{i}_{item.filename}"
+            attachments.append(discord.File(item.path, filename=filename))
+            embed.set_image(url=f"attachment://{filename}")
+        else:
+            embed.set_image(url=item.url)
+        embeds.append(embed)
+    kwargs = {"embeds": embeds}
+    if attachments:
+        kwargs["files"] = attachments
+    return await destination.send(**kwargs)
+
+async def send_media_batch(destination, files, style: MediaStyle, count: int):
+    """Elige `count` medios distintos, los prepara en paralelo y los envía agrupados."""
+    started = time.monotonic()
+    limit = upload_limit_for(destination)
+    candidates, gif_limit = shed_candidates(await _selectable_files(files), limit)
+    chosen = await asyncio.to_thread(select_random_files_with_limit, candidates, gif_limit, count)
+    if not chosen:
+        raise MediaUnavailable(f"No se encontró ninguna imagen/GIF dentro del límite de {gif_limit/1024/1024:.0f} MB.")
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def prepare_one(file):
+        async with semaphore:
+            return await work_scheduler.run(PRIORITY_INTERACTIVE, prepare_media, file, limit, style.label)
+
+    results = await asyncio.gather(*(prepare_one(f) for f in chosen), return_exceptions=True)
+    prepared = [r for r in results if isinstance(r, PreparedMedia)]
+    try:
+        for file, r in zip(chosen, results):
+            if isinstance(r, BaseException):
+                logger.warning(f"Lote: {file.get('name')} omitido: {r}")
+        if not prepared:
+            # Todos fallaron: se informa el primer motivo como en un envío simple
+            raise next(r for r in results if isinstance(r, BaseException))
+
+        groups = pack_batch(prepared, limit)
+        sent_messages = []
+        for group in groups:
+            try:
+                sent_messages.append(await _send_batch_message(destination, group, style))
+            except discord.HTTPException as e:
+                if e.status != 413:
+                    raise
+                # Con varios adjuntos no se sabe qué excedió el límite: solo se aprende
+                # de un adjunto suelto, y el grupo se envía de uno en uno
+                if len(group) == 1:
+                    record_payload_too_large(destination, group[0].size)
+                for item in group:
+                    message, sent_item = await send_within_limit(destination, item, style, style.quote())
+                    if sent_item is not item:
+                        prepared.append(sent_item)
+                    sent_messages.append(message)
+
+        if style.reaction:
+            for message in sent_messages:
+                try:
+                    await message.add_reaction(style.reaction)
+                except Exception:
+                    pass
+        logger.info(f"Lote de {len(prepared)}/{count} medios en {len(sent_messages)} mensaje(s) "
+                    f"({time.monotonic() - started:.1f}s)")
+    finally:
+        for item in prepared:
+            item.cleanup()
 
 # ==========================
-# Tarea automática: Auto-post KCD cada 8 horas
+# Tarea automática: programador de auto-posts
 # ==========================
 
-@tasks.loop(hours=8)
-async def auto_post_kcd():
-    """Post automático cada 8 horas con imagen random y frase KCD."""
-    if not KCD_POST_CHANNEL_ID:
+# Próxima ejecución (epoch) de cada programación, por nombre
+_schedule_next_runs = {}
+
+async def _post_to_channel(channel, prepared: PreparedMedia, schedule: PostSchedule):
+    """Publica en un canal; devuelve (mensaje, prepared) como send_within_limit."""
+    await fanout_limiter.acquire()
+    quote = schedule.quote()
+    message, prepared = await send_within_limit(channel, prepared, schedule.style, quote, PRIORITY_SCHEDULED)
+    logger.info("Auto-post enviado", extra={"schedule": schedule.name, "channel_id": channel.id, "quote": quote})
+    return message, prepared
+
+class UploadedRefs:
+    """URLs de adjuntos ya subidos a Discord, por contenido y límite de tamaño.
+
+    Las copias idénticas de un archivo comparten la referencia, así que un
+    mismo medio no se vuelve a subir mientras su URL firmada siga vigente.
+    """
+
+    # Margen antes de la caducidad firmada (`ex`) del CDN de Discord
+    EXPIRY_MARGIN_SECONDS = 3600
+    DEFAULT_TTL_SECONDS = 12 * 3600
+
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max_entries
+        self._refs = OrderedDict()  # clave -> (url, caducidad epoch)
+
+    @staticmethod
+    def _key(file: dict, max_bytes: int) -> str:
+        return f"{media_key(file)}:{max_bytes}"
+
+    @classmethod
+    def _expiry(cls, url: str) -> float:
+        ex = parse_qs(urlparse(url).query).get("ex")
+        try:
+            return int(ex[0], 16) if ex else time.time() + cls.DEFAULT_TTL_SECONDS
+        except ValueError:
+            return time.time() + cls.DEFAULT_TTL_SECONDS
+
+    def get(self, file: dict, max_bytes: int) -> Optional[str]:
+        key = self._key(file, max_bytes)
+        entry = self._refs.get(key)
+        if entry is None:
+            return None
+        url, expires = entry
+        if expires - time.time() < self.EXPIRY_MARGIN_SECONDS:
+            del self._refs[key]
+            return None
+        self._refs.move_to_end(key)
+        return url
+
+    def put(self, file: dict, max_bytes: int, url: str):
+        key = self._key(file, max_bytes)
+        self._refs[key] = (url, self._expiry(url))
+        self._refs.move_to_end(key)
+        while len(self._refs) > self.max_entries:
+            self._refs.popitem(last=False)
+
+uploaded_refs = UploadedRefs()
+
+def _shared_media_url(message, prepared: PreparedMedia) -> Optional[str]:
+    """URL reutilizable del medio ya enviado: la de Drive o la del adjunto en el CDN de Discord."""
+    if prepared.url:
+        return prepared.url
+    if message is not None and message.attachments:
+        return message.attachments[0].url
+    return None
+
+async def fan_out_post(due):
+    """Prepara un único medio y lo publica en todos los canales de las programaciones vencidas.
+
+    El archivo se sube una sola vez; el resto de canales reciben la URL del adjunto.
+    """
+    targets = []
+    for schedule in due:
+        for channel_id in schedule.channel_ids:
+            channel = bot.get_channel(channel_id)
+            if channel is None:
+                # Sin caché de canales (p. ej. intents recortados): pedirlo a la API
+                try:
+                    channel = await bot.fetch_channel(channel_id)
+                except discord.HTTPException:
+                    channel = None
+            if channel:
+                targets.append((channel, schedule))
+            else:
+                logger.error(f"Canal {schedule.name} {channel_id} no encontrado")
+    if not targets:
         return
-    
-    tmp_file = None
-    compressed_file = None
+
+    # Cada servidor puede tener su carpeta: un medio compartido por carpeta
+    by_folder = {}
+    for channel, schedule in targets:
+        guild = getattr(channel, "guild", None)
+        folder_id = folder_config.resolve(guild.id if guild else None, schedule.name)
+        by_folder.setdefault(folder_id, []).append((channel, schedule))
+    await asyncio.gather(*(_fan_out_folder(folder_id, group) for folder_id, group in by_folder.items()))
+
+async def _fan_out_folder(folder_id: str, targets: list):
+    prepared = None
     try:
-        channel = bot.get_channel(int(KCD_POST_CHANNEL_ID))
-        if not channel:
-            logger.error(f"Canal KCD {KCD_POST_CHANNEL_ID} no encontrado")
+        files = await asyncio.to_thread(get_all_media_files_from_folder, folder_id)
+        if not files:
+            logger.warning(f"No hay archivos en Drive para auto-post ({folder_id})")
             return
+        file = await pick_media_file(files, upload_limit_for(targets[0][0]))
+        # El archivo se prepara para el nivel de subida del primer canal; el resto recibe la URL
+        limit = upload_limit_for(targets[0][0])
+        shared_url = uploaded_refs.get(file, limit)
+        if shared_url:
+            # Ya subido antes (quizá bajo otra copia idéntica): nada que preparar ni subir
+            prepared = PreparedMedia(file, url=shared_url)
+        else:
+            prepared = await work_scheduler.run(PRIORITY_SCHEDULED, prepare_media, file, limit,
+                                                targets[0][1].style.label)
 
-        files = get_all_media_files_from_folder()
-        if not files:
-            logger.warning("No hay archivos en Drive para auto-post KCD")
+        # Primer envío con subida del archivo; si un canal falla se prueba con el siguiente
+        message = None
+        while targets and message is None:
+            channel, schedule = targets.pop(0)
+            try:
+                message, prepared = await _post_to_channel(channel, prepared, schedule)
+            except Exception as e:
+                logger.error(f"Error en auto-post {schedule.name} al canal {channel.id}: {e}")
+        if message is None:
             return
 
-        # Seleccionar archivo dentro del límite
-        file = select_random_file_with_limit(files, MAX_GIF_SIZE_BYTES)
-        if not file:
-            logger.warning(f"No se encontró archivo KCD dentro del límite de {MAX_GIF_MB} MB")
+        shared_url = _shared_media_url(message, prepared)
+        if shared_url and not prepared.url:
+            uploaded_refs.put(prepared.file, upload_limit_for(message.channel), shared_url)
+        if not targets:
             return
+        shared = PreparedMedia(prepared.file, url=shared_url) if shared_url else prepared
+        semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
 
-        url = f"https://drive.google.com/uc?export=download&id={file['id']}"
-        quote = random.choice(KCD_QUOTES)
-
-        if file['mimeType'] == 'image/gif':
-            r = requests.get(url, stream=True, timeout=30)
-            if r.status_code == 200:
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.gif') as tmp:
-                    tmp_file = tmp.name
-                    register_temp_file(tmp_file)
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            tmp.write(chunk)
-                    tmp.flush()
-                    tmp_size = os.path.getsize(tmp.name)
-                    
-                    if tmp_size > DISCORD_MAX_BYTES:
-                        if ffmpeg_available():
-                            logger.debug(f"Auto-post KCD GIF {file['name']} es {tmp_size} bytes, comprimiendo")
-                            compressed_file = compress_gif_with_ffmpeg(tmp.name, DISCORD_MAX_BYTES)
-                            if compressed_file and os.path.exists(compressed_file):
-                                comp_size = os.path.getsize(compressed_file)
-                                if comp_size <= DISCORD_MAX_BYTES:
-                                    await channel.send(content=quote, file=discord.File(compressed_file, filename=file['name']))
-                                    cleanup_temp_file(compressed_file)
-                                    cleanup_temp_file(tmp_file)
-                                    logger.info(f"Auto-post KCD enviado: {quote}")
-                                    return
-                            logger.warning("Auto-post KCD: compresión fallida")
-                            cleanup_temp_file(tmp_file)
-                            return
-                        else:
-                            logger.warning(f"Auto-post KCD: GIF muy grande y ffmpeg no disponible")
-                            cleanup_temp_file(tmp_file)
-                            return
-                    
-                    if tmp_size > MAX_GIF_SIZE_BYTES:
-                        logger.warning(f"Auto-post KCD: GIF muy grande ({tmp_size/1024/1024:.1f} MB)")
-                        cleanup_temp_file(tmp_file)
-                        return
-
-                    await channel.send(content=quote, file=discord.File(tmp.name, filename=file['name']))
-                    cleanup_temp_file(tmp_file)
-                    logger.info(f"Auto-post KCD enviado: {quote}")
-            else:
-                logger.error("Auto-post KCD: no se pudo descargar GIF")
-        else:
-            kcd_color = discord.Color.from_rgb(
-                random.randint(100, 200),
-                random.randint(100, 180),
-                random.randint(50, 120)
-            )
-            embed = discord.Embed(
-                title=quote,
-                color=kcd_color
-            )
-            embed.set_image(url=url)
-            await channel.send(embed=embed)
-            logger.info(f"Auto-post KCD enviado: {quote}")
-            
+        async def send_one(channel, schedule):
+            async with semaphore:
+                try:
+                    _, sent = await _post_to_channel(channel, shared, schedule)
+                    if sent is not shared:
+                        sent.cleanup()
+                except Exception as e:
+                    logger.error(f"Error en auto-post {schedule.name} al canal {channel.id}: {e}")
+
+        await asyncio.gather(*(send_one(channel, schedule) for channel, schedule in targets))
+    except MediaUnavailable as e:
+        logger.warning(f"Auto-post: {e}")
     except Exception as e:
-        logger.error(f"Error en auto-post KCD: {e}", exc_info=True)
+        logger.error(f"Error en auto-post: {e}", exc_info=True)
     finally:
-        if tmp_file:
-            cleanup_temp_file(tmp_file)
-        if compressed_file:
-            cleanup_temp_file(compressed_file)
-
-@auto_post_kcd.before_loop
-async def before_auto_post_kcd():
-    """Esperar a que el bot esté listo antes de iniciar el loop KCD."""
+        if prepared:
+            prepared.cleanup()
+
+@tasks.loop(seconds=SCHEDULE_TICK_SECONDS)
+async def auto_post_scheduler():
+    """Cada tick agrupa las programaciones vencidas y las publica juntas."""
+    now = time.time()
+    due = [s for s in AUTO_POST_SCHEDULES if _schedule_next_runs[s.name] <= now]
+    if not due:
+        return
+    for schedule in due:
+        next_run = schedule.next_run(_schedule_next_runs[schedule.name])
+        if next_run <= now:
+            # El bot estuvo parado o el tick se retrasó: no recuperar ejecuciones perdidas
+            next_run = schedule.next_run(now)
+        _schedule_next_runs[schedule.name] = next_run
+    await fan_out_post(due)
+
+@auto_post_scheduler.before_loop
+async def before_auto_post_scheduler():
+    """Esperar a que el bot esté listo y repartir las primeras ejecuciones."""
     await bot.wait_until_ready()
-    logger.info("Auto-post KCD loop listo para iniciar")
+    now = time.time()
+    for schedule in AUTO_POST_SCHEDULES:
+        _schedule_next_runs[schedule.name] = schedule.first_run(now)
+    logger.info("Programador de auto-posts listo para iniciar")
 
 # ==========================
 # Comandos
@@ -655,227 +3824,28 @@ async def before_auto_post_kcd():
 # !luke — modo normal
 # -----------------------------------
 @bot.command(name="luke", help="Random Luke image + normal quote")
-async def luke_command(ctx):
-    tmp_file = None
-    compressed_file = None
-    try:
-        files = get_all_media_files_from_folder()
-        if DEBUG:
-            await ctx.send(f"[DEBUG] Archivos en Drive: {len(files)}")
-        if not files:
-            await ctx.send("No images found in Drive folder.")
-            return
-
-        # Seleccionamos un archivo que cumpla el límite de tamaño para GIFs
-        file = select_random_file_with_limit(files, MAX_GIF_SIZE_BYTES)
-        if not file:
-            await ctx.send(f"No se encontró ninguna imagen/GIF dentro del límite de {MAX_GIF_MB} MB.")
-            return
-
-        url = f"https://drive.google.com/uc?export=download&id={file['id']}"
-        quote = random.choice(RANDOM_QUOTES)
-
-        if file['mimeType'] == 'image/gif':
-            # Descargamos y validamos el tamaño final antes de enviar
-            r = requests.get(url, stream=True, timeout=30)
-            if r.status_code == 200:
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.gif') as tmp:
-                    tmp_file = tmp.name
-                    register_temp_file(tmp_file)
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            tmp.write(chunk)
-                    tmp.flush()
-                    tmp_size = os.path.getsize(tmp.name)
-                    # If exceeds Discord per-file limit, attempt to compress to DISCORD_MAX_BYTES
-                    if tmp_size > DISCORD_MAX_BYTES:
-                        if ffmpeg_available():
-                            logger.debug(f"GIF {file['name']} es {tmp_size} bytes, intentando comprimir a {DISCORD_MAX_BYTES} bytes")
-                            compressed_file = compress_gif_with_ffmpeg(tmp.name, DISCORD_MAX_BYTES)
-                            if compressed_file and os.path.exists(compressed_file):
-                                comp_size = os.path.getsize(compressed_file)
-                                if comp_size <= DISCORD_MAX_BYTES:
-                                    await ctx.send(content=quote, file=discord.File(compressed_file, filename=file['name']))
-                                    cleanup_temp_file(compressed_file)
-                                    cleanup_temp_file(tmp_file)
-                                    return
-                                else:
-                                    await ctx.send(f"GIF omitido — no fue posible reducirlo por debajo de {DISCORD_MAX_MB} MB.")
-                                    cleanup_temp_file(compressed_file)
-                                    cleanup_temp_file(tmp_file)
-                                    return
-                            else:
-                                await ctx.send(f"GIF omitido — compresión fallida o ffmpeg no disponible.")
-                                cleanup_temp_file(tmp_file)
-                                return
-                        else:
-                            await ctx.send(f"GIF omitido — demasiado grande ({tmp_size/1024/1024:.1f} MB) y `ffmpeg` no está disponible para comprimir.")
-                            cleanup_temp_file(tmp_file)
-                            return
-
-                    if tmp_size > MAX_GIF_SIZE_BYTES:
-                        await ctx.send(f"GIF omitido — demasiado grande ({tmp_size/1024/1024:.1f} MB). Límite: {MAX_GIF_MB} MB.")
-                        cleanup_temp_file(tmp_file)
-                        return
-
-                    sent = await ctx.send(content=quote, file=discord.File(tmp.name, filename=file['name']))
-                    cleanup_temp_file(tmp_file)
-                    try:
-                        await sent.add_reaction("✨")
-                    except Exception:
-                        pass
-            else:
-                sent = await ctx.send("No se pudo descargar el GIF.")
-                try:
-                    await sent.add_reaction("✨")
-                except Exception:
-                    pass
-        else:
-            random_color = discord.Color.from_rgb(
-                random.randint(0,255),
-                random.randint(0,255),
-                random.randint(0,255),
-            )
-            embed = discord.Embed(
-                title=quote,
-                color=random_color
-            )
-            embed.set_image(url=url)
-            sent = await ctx.send(embed=embed)
-            try:
-                await sent.add_reaction("✨")
-            except Exception:
-                pass
-    except requests.Timeout:
-        logger.error("Timeout descargando imagen")
-        await ctx.send("Timeout al descargar la imagen. Intenta de nuevo.")
-    except Exception as e:
-        logger.error(f"Error en comando !luke: {e}", exc_info=True)
-        await ctx.send("Ocurrió un error. Intenta de nuevo.")
-    finally:
-        if tmp_file:
-            cleanup_temp_file(tmp_file)
-        if compressed_file:
-            cleanup_temp_file(compressed_file)
+async def luke_command(ctx, count: int = 1):
+    await send_random_media(ctx, "luke", count)
 
 # -----------------------------------
 # !spicyluke — modo SPICY 🔥
 # -----------------------------------
 @bot.command(name="spicyluke", help="SPICY Luke image + spicy quote 🔥")
-async def spicyluke_command(ctx):
-    tmp_file = None
-    compressed_file = None
-    try:
-        files = get_all_media_files_from_folder()
-        if DEBUG:
-            await ctx.send(f"[DEBUG] Archivos en Drive: {len(files)}")
-        if not files:
-            await ctx.send("No spicy material found in Drive 😳")
-            return
-
-        # Seleccionamos un archivo que cumpla el límite de tamaño para GIFs
-        file = select_random_file_with_limit(files, MAX_GIF_SIZE_BYTES)
-        if not file:
-            await ctx.send(f"No se encontró ninguna imagen/GIF spicy dentro del límite de {MAX_GIF_MB} MB.")
-            return
-
-        url = f"https://drive.google.com/uc?export=download&id={file['id']}"
-        quote = random.choice(SPICY_QUOTES)
-
-        if file['mimeType'] == 'image/gif':
-            r = requests.get(url, stream=True, timeout=30)
-            if r.status_code == 200:
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.gif') as tmp:
-                    tmp_file = tmp.name
-                    register_temp_file(tmp_file)
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            tmp.write(chunk)
-                    tmp.flush()
-                    tmp_size = os.path.getsize(tmp.name)
-                    # If exceeds Discord per-file limit, attempt to compress to DISCORD_MAX_BYTES
-                    if tmp_size > DISCORD_MAX_BYTES:
-                        if ffmpeg_available():
-                            logger.debug(f"GIF spicy {file['name']} es {tmp_size} bytes, intentando comprimir a {DISCORD_MAX_BYTES} bytes")
-                            compressed_file = compress_gif_with_ffmpeg(tmp.name, DISCORD_MAX_BYTES)
-                            if compressed_file and os.path.exists(compressed_file):
-                                comp_size = os.path.getsize(compressed_file)
-                                if comp_size <= DISCORD_MAX_BYTES:
-                                    await ctx.send(content=f"🔥 {quote}", file=discord.File(compressed_file, filename=file['name']))
-                                    cleanup_temp_file(compressed_file)
-                                    cleanup_temp_file(tmp_file)
-                                    return
-                                else:
-                                    await ctx.send(f"GIF spicy omitido — no fue posible reducirlo por debajo de {DISCORD_MAX_MB} MB.")
-                                    cleanup_temp_file(compressed_file)
-                                    cleanup_temp_file(tmp_file)
-                                    return
-                            else:
-                                await ctx.send(f"GIF spicy omitido — compresión fallida o ffmpeg no disponible.")
-                                cleanup_temp_file(tmp_file)
-                                return
-                        else:
-                            await ctx.send(f"GIF spicy omitido — demasiado grande ({tmp_size/1024/1024:.1f} MB) y `ffmpeg` no está disponible para comprimir.")
-                            cleanup_temp_file(tmp_file)
-                            return
-
-                    if tmp_size > MAX_GIF_SIZE_BYTES:
-                        await ctx.send(f"GIF spicy omitido — demasiado grande ({tmp_size/1024/1024:.1f} MB). Límite: {MAX_GIF_MB} MB.")
-                        cleanup_temp_file(tmp_file)
-                        return
-
-                    sent = await ctx.send(content=f"🔥 {quote}", file=discord.File(tmp.name, filename=file['name']))
-                    cleanup_temp_file(tmp_file)
-                    try:
-                        await sent.add_reaction("✨")
-                    except Exception:
-                        pass
-            else:
-                sent = await ctx.send("No se pudo descargar el GIF spicy.")
-                try:
-                    await sent.add_reaction("✨")
-                except Exception:
-                    pass
-        else:
-            spicy_color = discord.Color.from_rgb(
-                random.randint(180,255),
-                random.randint(0,80),
-                random.randint(50,200),
-            )
-            embed = discord.Embed(
-                title=quote,
-                description="🔥 Spicy Mode Activated 🔥",
-                color=spicy_color
-            )
-            embed.set_image(url=url)
-            sent = await ctx.send(embed=embed)
-            try:
-                await sent.add_reaction("✨")
-            except Exception:
-                pass
-    except requests.Timeout:
-        logger.error("Timeout descargando imagen spicy")
-        await ctx.send("Timeout al descargar la imagen. Intenta de nuevo.")
-    except Exception as e:
-        logger.error(f"Error en comando !spicyluke: {e}", exc_info=True)
-        await ctx.send("Ocurrió un error. Intenta de nuevo.")
-    finally:
-        if tmp_file:
-            cleanup_temp_file(tmp_file)
-        if compressed_file:
-            cleanup_temp_file(compressed_file)
+async def spicyluke_command(ctx, count: int = 1):
+    await send_random_media(ctx, "spicyluke", count)
 
 # -----------------------------------
 # !lukeyhelp — instrucciones
 # -----------------------------------
-@bot.command(name="lukeyhelp", help="Shows instructions for LukeyBot")
-async def lukeyhelp(ctx):
-    embed = discord.Embed(
+def build_help_embed() -> discord.Embed:
+    p = "/" if COMMAND_MODE == "slash" else "!"
+    return discord.Embed(
         title="📸 LukeyBot — Instructions",
         description=(
-            "**!luke** — random Luke image + random quote\n"
-            "**!spicyluke** — spicy Luke image + spicy quote 🔥\n"
-            "**!almendras** — random Luke image + random nut type 🌰\n"
+            f"**{p}luke** — random Luke image + random quote\n"
+            f"**{p}luke 5** — several at once (up to {BATCH_MAX_ITEMS}, also for spicyluke/almendras)\n"
+            f"**{p}spicyluke** — spicy Luke image + spicy quote 🔥\n"
+            f"**{p}almendras** — random Luke image + random nut type 🌰\n"
             "**Auto-Post (6h)** — Random Luke + ALMONDS quote 🌰\n"
             "**Auto-Post (8h)** — Random Luke + KCD quote ⚔️\n"
             "**Source:** Google Drive folder (JPG, PNG, GIF)\n\n"
@@ -884,128 +3854,373 @@ async def lukeyhelp(ctx):
         ),
         color=discord.Color.blurple()
     )
-    await ctx.send(embed=embed)
+
+@bot.command(name="lukeyhelp", help="Shows instructions for LukeyBot")
+async def lukeyhelp(ctx):
+    await ctx.send(embed=build_help_embed())
 
 
 @bot.command(name="ping", help="Check bot latency")
 async def ping(ctx):
-    latency_ms = round(bot.latency * 1000)
-    await ctx.send(f"Pong! Latencia: {latency_ms} ms")
+    await ctx.send(latency_report())
 
 # -----------------------------------
 # !almendras — imagen + tipo de nuez
 # -----------------------------------
 @bot.command(name="almendras", help="Random Luke image + random nut type 🌰")
-async def almendras_command(ctx):
-    tmp_file = None
-    compressed_file = None
-    try:
-        files = get_all_media_files_from_folder()
-        if DEBUG:
-            await ctx.send(f"[DEBUG] Archivos en Drive: {len(files)}")
-        if not files:
-            await ctx.send("No hay almendras en el Drive 🌰")
-            return
+async def almendras_command(ctx, count: int = 1):
+    await send_random_media(ctx, "almendras", count)
 
-        # Seleccionar archivo dentro del límite
-        file = select_random_file_with_limit(files, MAX_GIF_SIZE_BYTES)
-        if not file:
-            await ctx.send(f"No se encontró ninguna imagen/GIF dentro del límite de {MAX_GIF_MB} MB.")
-            return
+# ==========================
+# Comandos slash (interacciones)
+# ==========================
+# Con COMMAND_MODE=slash el bot no necesita el intent privilegiado de
+# contenido de mensajes. Cada interacción se difiere al instante y el medio
+# se envía como follow-up, así las descargas lentas no chocan con el plazo
+# de 3 segundos de Discord.
 
-        url = f"https://drive.google.com/uc?export=download&id={file['id']}"
-        quote = random.choice(ALMONDS_QUOTES)
-
-        if file['mimeType'] == 'image/gif':
-            r = requests.get(url, stream=True, timeout=30)
-            if r.status_code == 200:
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.gif') as tmp:
-                    tmp_file = tmp.name
-                    register_temp_file(tmp_file)
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            tmp.write(chunk)
-                    tmp.flush()
-                    tmp_size = os.path.getsize(tmp.name)
-                    
-                    if tmp_size > DISCORD_MAX_BYTES:
-                        if ffmpeg_available():
-                            logger.debug(f"GIF almendras {file['name']} es {tmp_size} bytes, intentando comprimir a {DISCORD_MAX_BYTES} bytes")
-                            compressed_file = compress_gif_with_ffmpeg(tmp.name, DISCORD_MAX_BYTES)
-                            if compressed_file and os.path.exists(compressed_file):
-                                comp_size = os.path.getsize(compressed_file)
-                                if comp_size <= DISCORD_MAX_BYTES:
-                                    await ctx.send(content=quote, file=discord.File(compressed_file, filename=file['name']))
-                                    cleanup_temp_file(compressed_file)
-                                    cleanup_temp_file(tmp_file)
-                                    return
-                                else:
-                                    await ctx.send(f"GIF omitido — no fue posible reducirlo por debajo de {DISCORD_MAX_MB} MB.")
-                                    cleanup_temp_file(compressed_file)
-                                    cleanup_temp_file(tmp_file)
-                                    return
-                            else:
-                                await ctx.send(f"GIF omitido — compresión fallida o ffmpeg no disponible.")
-                                cleanup_temp_file(tmp_file)
-                                return
-                        else:
-                            await ctx.send(f"GIF omitido — demasiado grande ({tmp_size/1024/1024:.1f} MB) y `ffmpeg` no está disponible para comprimir.")
-                            cleanup_temp_file(tmp_file)
-                            return
-
-                    if tmp_size > MAX_GIF_SIZE_BYTES:
-                        await ctx.send(f"GIF omitido — demasiado grande ({tmp_size/1024/1024:.1f} MB). Límite: {MAX_GIF_MB} MB.")
-                        cleanup_temp_file(tmp_file)
-                        return
-
-                    sent = await ctx.send(content=quote, file=discord.File(tmp.name, filename=file['name']))
-                    cleanup_temp_file(tmp_file)
-                    try:
-                        await sent.add_reaction("🌰")
-                    except Exception:
-                        pass
-            else:
-                sent = await ctx.send("No se pudo descargar el GIF de almendras.")
-                try:
-                    await sent.add_reaction("🌰")
-                except Exception:
-                    pass
+class InteractionDestination:
+    """Adapta una interacción ya diferida a la interfaz `send` de un canal."""
+
+    def __init__(self, interaction: discord.Interaction):
+        self.interaction = interaction
+
+    @property
+    def guild(self):
+        return self.interaction.guild
+
+    async def send(self, content=None, **kwargs):
+        return await self.interaction.followup.send(content=content, wait=True, **kwargs)
+
+async def send_random_media_interaction(interaction: discord.Interaction, style_name: str, count: int = 1):
+    await interaction.response.defer(thinking=True)
+    await send_random_media(InteractionDestination(interaction), style_name, count)
+
+@bot.tree.command(name="luke", description="Random Luke image + normal quote")
+@app_commands.describe(count="How many images (1-10)")
+async def luke_slash(interaction: discord.Interaction, count: app_commands.Range[int, 1, 10] = 1):
+    await send_random_media_interaction(interaction, "luke", count)
+
+@bot.tree.command(name="spicyluke", description="SPICY Luke image + spicy quote 🔥")
+@app_commands.describe(count="How many images (1-10)")
+async def spicyluke_slash(interaction: discord.Interaction, count: app_commands.Range[int, 1, 10] = 1):
+    await send_random_media_interaction(interaction, "spicyluke", count)
+
+@bot.tree.command(name="almendras", description="Random Luke image + random nut type 🌰")
+@app_commands.describe(count="How many images (1-10)")
+async def almendras_slash(interaction: discord.Interaction, count: app_commands.Range[int, 1, 10] = 1):
+    await send_random_media_interaction(interaction, "almendras", count)
+
+@bot.tree.command(name="lukeyhelp", description="Shows instructions for LukeyBot")
+async def lukeyhelp_slash(interaction: discord.Interaction):
+    await interaction.response.send_message(embed=build_help_embed())
+
+@bot.tree.command(name="ping", description="Check bot latency")
+async def ping_slash(interaction: discord.Interaction):
+    await interaction.response.send_message(latency_report())
+
+_slash_synced = False
+
+async def sync_slash_commands():
+    """Registra los comandos slash en Discord (una vez por proceso)."""
+    global _slash_synced
+    if _slash_synced or COMMAND_MODE == "prefix":
+        return
+    try:
+        if SLASH_SYNC_GUILD_ID:
+            guild = discord.Object(id=int(SLASH_SYNC_GUILD_ID))
+            bot.tree.copy_global_to(guild=guild)
+            synced = await bot.tree.sync(guild=guild)
         else:
-            almendras_color = discord.Color.from_rgb(
-                random.randint(150, 220),
-                random.randint(120, 180),
-                random.randint(80, 140)
-            )
-            embed = discord.Embed(
-                title=quote,
-                color=almendras_color
-            )
-            embed.set_image(url=url)
-            sent = await ctx.send(embed=embed)
-            try:
-                await sent.add_reaction("🌰")
-            except Exception:
-                pass
-    except requests.Timeout:
-        logger.error("Timeout descargando imagen almendras")
-        await ctx.send("Timeout al descargar la imagen. Intenta de nuevo.")
+            synced = await bot.tree.sync()
+        _slash_synced = True
+        logger.info(f"Sincronizados {len(synced)} comandos slash")
     except Exception as e:
-        logger.error(f"Error en comando !almendras: {e}", exc_info=True)
-        await ctx.send("Ocurrió un error. Intenta de nuevo.")
+        logger.error(f"Error sincronizando comandos slash: {e}", exc_info=True)
+
+# ==========================
+# Precompute (línea de órdenes)
+# ==========================
+# `python lukeybot.py precompute` recorre las carpetas configuradas, descarga
+# todos los originales a la caché local y comprime de antemano los GIF que
+# superan el límite de subida, para que nadie espere a una compresión dentro
+# de un comando. Pensado para lanzarlo tras subir muchos archivos a Drive.
+#
+# Lo ya cacheado se salta, así que se puede interrumpir y relanzar; las
+# compresiones que no alcanzaron el objetivo se apuntan en
+# MEDIA_CACHE_DIR/precompute.json y no se reintentan salvo con --retry-failed.
+
+def _precompute_state_path() -> str:
+    # En un subdirectorio, como catalog/: lo que está en la raíz de la caché es una entrada del LRU
+    return os.path.join(MEDIA_CACHE_DIR, "state", "precompute.json")
+
+def _load_precompute_state() -> dict:
+    # La ruta antigua (raíz de la caché) solo se lee si aún no hay estado nuevo
+    for path in (_precompute_state_path(), os.path.join(MEDIA_CACHE_DIR, "precompute.json")):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            continue
+    return {"failed": {}}
+
+def _save_precompute_state(state: dict):
+    os.makedirs(os.path.dirname(_precompute_state_path()), exist_ok=True)
+    tmp = _precompute_state_path() + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, _precompute_state_path())
+
+def _precompute_worker_init():
+    # El hilo del QueueListener no existe en el proceso hijo: registrar directo a stderr
+    root = logging.getLogger()
+    root.handlers[:] = [logging.StreamHandler(sys.stderr)]
+    root.handlers[0].setFormatter(TextFormatter())
+
+def _precompute_transcode(src_path: str, target_bytes: int, staging: str) -> Optional[tuple]:
+    """Trabajo de un proceso del pool: comprime y deja el resultado en staging de la caché.
+
+    Devuelve (bytes de salida, segundos) o None si no se alcanzó el objetivo.
+    """
+    started = time.monotonic()
+    out_path = compress_gif(src_path, target_bytes)
+    if not out_path:
+        return None
+    try:
+        # El scratch del hijo puede ser memfd (invisible para el padre): copiar a la caché
+        # `staging` lleva el pid del padre, que es quien la mueve a la caché
+        shutil.copyfile(out_path, staging)
+        return os.path.getsize(out_path), time.monotonic() - started
     finally:
-        if tmp_file:
-            cleanup_temp_file(tmp_file)
-        if compressed_file:
-            cleanup_temp_file(compressed_file)
+        scratch.release(out_path)
+
+class PrecomputeSummary:
+    """Contadores de una ejecución de precompute."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.files = 0
+        self.downloaded = 0
+        self.downloaded_bytes = 0
+        self.download_failures = 0
+        self.variants = 0
+        self.transcoded = 0
+        self.transcode_failures = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.transcode_seconds = 0.0
+
+    def report(self) -> str:
+        elapsed = time.monotonic() - self.started
+        saved = self.bytes_in - self.bytes_out
+        return "\n".join([
+            f"Archivos revisados:   {self.files}",
+            f"Descargados:          {self.downloaded} ({self.downloaded_bytes/1024/1024:.1f} MB), {self.download_failures} fallidos",
+            f"Variantes de imagen:  {self.variants}",
+            f"GIFs comprimidos:     {self.transcoded}, {self.transcode_failures} sin alcanzar el objetivo, {self.skipped} ya hechos",
+            f"Bytes ahorrados:      {saved/1024/1024:.1f} MB ({self.bytes_in/1024/1024:.1f} -> {self.bytes_out/1024/1024:.1f} MB)",
+            f"Tiempo:               {elapsed:.1f}s total, {self.transcode_seconds:.1f}s de CPU en compresiones",
+        ])
+
+def _precompute_plan(files: list, tiers: list, state: dict, retry_failed: bool) -> list:
+    """Trabajo pendiente por contenido: (archivo, descargar?, [límites a comprimir])."""
+    plan = []
+    for group in group_duplicates(files).values():
+        file = group[0]
+        size = int(file.get("size") or 0)
+        if size > MAX_GIF_SIZE_BYTES:
+            continue
+        needs_download = not media_cache.contains(original_cache_key(file))
+        pending = []
+        if file.get("mimeType") == "image/gif":
+            for tier in tiers:
+                key = compressed_cache_key(file, tier)
+                if size <= tier or media_cache.contains(key):
+                    continue
+                if key in state["failed"] and not retry_failed:
+                    continue
+                pending.append(tier)
+        plan.append((file, needs_download, pending))
+    return plan
+
+def precompute_dry_run(folders: dict, tiers: list, state: dict, retry_failed: bool):
+    """Informe de tamaños sin descargar ni comprimir nada."""
+    total_download = total_library = 0
+    total_transcodes = 0
+    predicted_seconds = 0.0
+    for folder_id, files in folders.items():
+        plan = _precompute_plan(files, tiers, state, retry_failed)
+        library = sum(int(f.get("size") or 0) for f, _, _ in plan)
+        download = sum(int(f.get("size") or 0) for f, needs, _ in plan if needs)
+        transcodes = sum(len(p) for _, _, p in plan)
+        for file, _, pending in plan:
+            for tier in pending:
+                backends = choose_transcoders(int(file.get("size") or 0), tier)
+                if backends:
+                    predicted_seconds += backends[0].predict(int(file.get("size") or 0))[0]
+        gifs = sum(1 for f, _, _ in plan if f.get("mimeType") == "image/gif")
+        print(f"{folder_id}: {len(files)} archivos ({len(plan)} únicos, {gifs} GIFs), "
+              f"{library/1024/1024:.1f} MB; por descargar {download/1024/1024:.1f} MB; "
+              f"compresiones pendientes {transcodes}")
+        total_download += download
+        total_library += library
+        total_transcodes += transcodes
+    print(f"\nTotal: {total_library/1024/1024:.1f} MB en la biblioteca, {total_download/1024/1024:.1f} MB por descargar, "
+          f"{total_transcodes} compresiones (~{predicted_seconds/60:.0f} min de CPU estimados) "
+          f"para los límites {', '.join(f'{t/1024/1024:g} MB' for t in tiers)}")
+    if total_library > MEDIA_CACHE_MB * 1024 * 1024:
+        print(f"Aviso: la biblioteca no cabe en la caché (MEDIA_CACHE_MB={MEDIA_CACHE_MB}); "
+              f"lo más antiguo se irá expulsando")
+
+def _precompute_fetch(file: dict) -> tuple:
+    """Descarga (o encuentra) el original cacheado y la variante si es imagen.
+
+    Devuelve (ruta cacheada o None, bytes descargados, variante nueva?, fallo?).
+    """
+    needs_download = not media_cache.contains(original_cache_key(file))
+    try:
+        path, is_temp = fetch_original(file, os.path.splitext(file["name"])[1] or None)
+    except (MediaUnavailable, requests.RequestException) as e:
+        logger.warning(f"Precompute: {file['name']} no descargado: {e}")
+        return None, 0, False, True
+    if not path:
+        return None, 0, False, True
+    downloaded = os.path.getsize(path) if needs_download else 0
+    new_variant = False
+    if file.get("mimeType") != "image/gif":
+        had_variant = media_cache.contains(image_variant_key(file))
+        new_variant = bool(get_image_variant(file)) and not had_variant
+    if is_temp:
+        # Más grande que la caché admite: no se puede comprimir de antemano
+        scratch.release(path)
+        path = None
+    return path, downloaded, new_variant, False
+
+def precompute_default_tiers() -> list:
+    """Límites que el bot consulta en la caché: los niveles de subida por debajo de MAX_GIF_MB.
+
+    Un GIF mayor que MAX_GIF_MB no se sirve, así que los niveles superiores nunca comprimen.
+    """
+    if not UPLOAD_LIMIT_PER_GUILD:
+        return [DISCORD_MAX_BYTES]
+    return [t for t in UPLOAD_TIERS if t < MAX_GIF_SIZE_BYTES] or [DISCORD_MAX_BYTES]
+
+def run_precompute(argv: list) -> int:
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import multiprocessing
+
+    parser = argparse.ArgumentParser(prog="lukeybot.py precompute",
+                                     description="Descarga la biblioteca a la caché y comprime de antemano los GIF grandes.")
+    parser.add_argument("--folder", action="append", help="carpeta de Drive (por defecto, todas las configuradas)")
+    parser.add_argument("--tiers", help="límites de subida en MB para los que comprimir, separados por comas "
+                                        "(por defecto, los niveles que usa el bot)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="procesos de compresión")
+    parser.add_argument("--download-workers", type=int, default=4, help="descargas simultáneas")
+    parser.add_argument("--dry-run", action="store_true", help="solo informar de tamaños y trabajo pendiente")
+    parser.add_argument("--retry-failed", action="store_true", help="reintentar compresiones que fallaron antes")
+    args = parser.parse_args(argv)
+
+    if args.tiers:
+        tiers = sorted({int(float(t) * 1024 * 1024) for t in args.tiers.split(",") if t.strip()})
+    else:
+        tiers = precompute_default_tiers()
+    folder_ids = args.folder or sorted(folder_config.folders())
+    state = _load_precompute_state()
+
+    folders = {}
+    for folder_id in folder_ids:
+        try:
+            files = list_folder_media(folder_id)
+        except Exception as e:
+            logger.error(f"Precompute: no se pudo listar {folder_id}: {e}")
+            continue
+        _save_catalog(folder_id, MediaCatalog(_selection_view(files)))
+        folders[folder_id] = files
+
+    if args.dry_run:
+        precompute_dry_run(folders, tiers, state, args.retry_failed)
+        return 0
+
+    if not transcoders_available():
+        logger.warning("Precompute: no hay transcoders; solo se descargará")
+    summary = PrecomputeSummary()
+    plan = []
+    for files in folders.values():
+        plan.extend(_precompute_plan(files, tiers, state, args.retry_failed))
+    summary.files = len(plan)
+    summary.skipped = sum(1 for files in folders.values() for group in group_duplicates(files).values()
+                          for tier in tiers if media_cache.contains(compressed_cache_key(group[0], tier)))
+
+    # fork: los procesos se crean ya, antes de arrancar los hilos de descarga
+    context = multiprocessing.get_context("fork") if hasattr(os, "fork") else None
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), mp_context=context,
+                             initializer=_precompute_worker_init) as pool, \
+            ThreadPoolExecutor(max_workers=max(1, args.download_workers)) as downloads:
+        pool.submit(int).result()
+        fetches = {downloads.submit(_precompute_fetch, file): (file, pending) for file, _, pending in plan}
+        transcodes = {}
+        for done in as_completed(fetches):
+            file, pending = fetches[done]
+            path, downloaded, new_variant, failed = done.result()
+            summary.download_failures += failed
+            summary.downloaded += bool(downloaded)
+            summary.downloaded_bytes += downloaded
+            summary.variants += new_variant
+            if not path or not transcoders_available():
+                continue
+            for tier in pending:
+                key = compressed_cache_key(file, tier)
+                staging = media_cache.staging_path(key)
+                transcodes[pool.submit(_precompute_transcode, path, tier, staging)] = (file, tier, key, staging)
+        logger.info(f"Precompute: descargas terminadas, {len(transcodes)} compresiones en {args.workers} procesos")
+
+        for done in as_completed(transcodes):
+            file, tier, key, staging = transcodes[done]
+            size = int(file.get("size") or 0)
+            try:
+                result = done.result()
+            except Exception as e:
+                result = None
+                logger.error(f"Precompute: error comprimiendo {file['name']}: {e}")
+            if result is None:
+                summary.transcode_failures += 1
+                state["failed"][key] = file["name"]
+                if os.path.exists(staging):
+                    os.remove(staging)
+                continue
+            out_bytes, seconds = result
+            media_cache.put(key, staging)
+            state["failed"].pop(key, None)
+            summary.transcoded += 1
+            summary.bytes_in += size
+            summary.bytes_out += out_bytes
+            summary.transcode_seconds += seconds
+            logger.info(f"Precompute: {file['name']} {size/1024/1024:.1f} -> {out_bytes/1024/1024:.1f} MB "
+                        f"(límite {tier/1024/1024:g} MB, {seconds:.1f}s)")
+
+    _save_precompute_state(state)
+    print(summary.report())
+    return 0 if not summary.download_failures and not summary.transcode_failures else 1
 
 # ==========================
 # Run bot
 # ==========================
 
-if __name__ == "__main__":
+if __name__ == "__main__" and CLI_COMMAND == "precompute":
+    try:
+        sys.exit(run_precompute(sys.argv[2:]))
+    finally:
+        cleanup_temp_files()
+elif __name__ == "__main__":
+    if CLI_COMMAND:
+        logger.error(f"Subcomando desconocido: {CLI_COMMAND} (disponible: precompute)")
+        sys.exit(2)
     try:
         logger.info("Iniciando LukeyBot...")
-        bot.run(DISCORD_TOKEN, reconnect=True)
+        # log_handler=None: discord.py usa el pipeline de logging del bot en vez del suyo
+        bot.run(DISCORD_TOKEN, reconnect=True, log_handler=None)
     except KeyboardInterrupt:
         logger.info("Bot detenido por usuario")
     except Exception as e: